@@ -0,0 +1,177 @@
+import time
+import threading
+from collections import deque
+
+
+class _BackendLatency:
+    __slots__ = ('name', 'recent', 'samples', 'minima', 'gradient', 'updated')
+
+    def __init__(self, name):
+        self.name = name
+        self.recent = None
+        self.samples = 0
+        self.minima = deque()
+        self.gradient = 1.0
+        self.updated = 0
+
+
+class AdaptiveLimit:
+    """Global concurrency limit that follows how far backend latency is above its no-load latency.
+
+    Every backend keeps a moving average of its recent call latencies and,
+    as its no-load latency, the lowest such average of the last
+    `baseline_seconds`. Its gradient is tolerance * no-load / recent, within
+    [0.5, 1]. Each finished request moves the limit by `smoothing` towards
+    limit * gradient + sqrt(limit), with the gradient of the most loaded
+    backend, of those named in `backends` if given: a fast backend, like a
+    wiki lookup, must not hide the overload of the slow ones. sqrt(limit)
+    lets the limit grow while they keep up.
+    """
+
+    BUCKET_SECONDS = 10
+    MIN_SAMPLES = 20
+    STALE_SECONDS = 60
+
+    def __init__(self, initial_limit=100, min_limit=10, max_limit=1000, tolerance=2.0, smoothing=0.02,
+                 baseline_seconds=600, backends=None):
+        self.__in_flight = 0
+        self.__backends = {}
+        self.__lock = threading.Lock()
+        self.configure(initial_limit, min_limit, max_limit, tolerance, smoothing, baseline_seconds, backends)
+
+    def configure(self, initial_limit=100, min_limit=10, max_limit=1000, tolerance=2.0, smoothing=0.02,
+                  baseline_seconds=600, backends=None):
+        with self.__lock:
+            self.__limit = float(min(initial_limit, max_limit))
+            self.__min_limit = min_limit
+            self.__max_limit = max_limit
+            self.__tolerance = tolerance
+            self.__smoothing = smoothing
+            self.__baseline_buckets = max(int(baseline_seconds // self.BUCKET_SECONDS), 1)
+            self.__names = set(backends) if backends else None
+
+    def acquire(self):
+        with self.__lock:
+            if self.__in_flight >= int(self.__limit):
+                return False
+            self.__in_flight += 1
+            return True
+
+    def observe(self, backend, latency, name=None):
+        """Takes the latency of one call to `backend`, a replica of service `name`, timed out calls included."""
+        now = time.time()
+        with self.__lock:
+            state = self.__backends.get(backend)
+            if state is None:
+                state = self.__backends[backend] = _BackendLatency(name)
+            state.recent = latency if state.recent is None else state.recent + (latency - state.recent) * 0.1
+            state.samples += 1
+            state.updated = now
+            if state.samples < self.MIN_SAMPLES:
+                return
+
+            bucket = int(now // self.BUCKET_SECONDS)
+            if state.minima and state.minima[-1][0] == bucket:
+                if state.recent < state.minima[-1][1]:
+                    state.minima[-1] = (bucket, state.recent)
+            else:
+                state.minima.append((bucket, state.recent))
+            while state.minima[0][0] <= bucket - self.__baseline_buckets:
+                state.minima.popleft()
+            baseline = min(minimum for _, minimum in state.minima)
+            state.gradient = min(max(self.__tolerance * baseline / state.recent, 0.5), 1.0)
+
+    def release(self):
+        now = time.time()
+        with self.__lock:
+            self.__in_flight -= 1
+            gradient = None
+            for backend, state in list(self.__backends.items()):
+                if now - state.updated > self.STALE_SECONDS:
+                    # a backend that is gone, or no longer called, says nothing about the load
+                    del self.__backends[backend]
+                elif state.samples < self.MIN_SAMPLES:
+                    continue
+                elif self.__names is None or state.name in self.__names:
+                    gradient = state.gradient if gradient is None else min(gradient, state.gradient)
+            if gradient is None:
+                return
+            target = self.__limit * gradient + self.__limit ** 0.5
+            limit = self.__limit + (target - self.__limit) * self.__smoothing
+            self.__limit = min(max(limit, self.__min_limit), self.__max_limit)
+
+    @property
+    def limit(self):
+        return int(self.__limit)
+
+    @property
+    def in_flight(self):
+        return self.__in_flight
+
+
+class _UidState:
+    __slots__ = ('in_flight', 'tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.in_flight = 0
+        self.tokens = tokens
+        self.updated = now
+
+
+class UidLimits:
+    """Per-uid in-flight limit and token bucket, sharded by uid to keep locks uncontended."""
+
+    def __init__(self, shards=64, max_uids_per_shard=10000):
+        self.__shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.__max_uids_per_shard = max_uids_per_shard
+        self.__max_in_flight = 0
+        self.__rate = None
+        self.__burst = 1
+
+    def update(self, max_in_flight, rate=None, burst=None):
+        self.__max_in_flight = max_in_flight
+        self.__rate = rate
+        self.__burst = burst or 1
+
+    def __shard(self, uid):
+        return self.__shards[hash(uid) % len(self.__shards)]
+
+    def __refill(self, state, now):
+        if self.__rate:
+            state.tokens = min(state.tokens + (now - state.updated) * self.__rate, self.__burst)
+        state.updated = now
+
+    def acquire(self, uid):
+        now = time.time()
+        states, lock = self.__shard(uid)
+        with lock:
+            state = states.get(uid)
+            if state is None:
+                if len(states) >= self.__max_uids_per_shard:
+                    self.__sweep(states, now)
+                state = states[uid] = _UidState(self.__burst, now)
+            self.__refill(state, now)
+            if state.in_flight >= self.__max_in_flight:
+                return False
+            if self.__rate:
+                if state.tokens < 1:
+                    return False
+                state.tokens -= 1
+            state.in_flight += 1
+            return True
+
+    def release(self, uid):
+        states, lock = self.__shard(uid)
+        with lock:
+            state = states.get(uid)
+            if state is None or state.in_flight == 0:
+                raise Exception('called on_request_finished on unknown uid {}'.format(uid))
+            state.in_flight -= 1
+
+    def __sweep(self, states, now):
+        # uids with nothing in flight and a full bucket carry no state worth keeping
+        for uid in list(states):
+            state = states[uid]
+            self.__refill(state, now)
+            if not state.in_flight and state.tokens >= self.__burst:
+                del states[uid]
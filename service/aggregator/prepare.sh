@@ -20,4 +20,8 @@ sudo apt-get install python3.7-venv -y
 python3.7 -m venv env
 source env/bin/activate
 
-pip install -r ./requirements.txt
\ No newline at end of file
+pip install -r ./requirements.txt
+# retrieval index for fallback replies, built from the dialogues the models were trained on;
+# add more dialogue files, like train_merged.txt, with more --input
+wget -O train.txt https://www.dropbox.com/s/oa3v9c7g9bp40xw/train.txt?dl=0
+python ../retrieval.py build --output fallback_index --input train.txt
@@ -0,0 +1,109 @@
+import time
+import random
+import threading
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ReplicaStats:
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0
+        self.open_seconds = 0
+
+
+class Balancer:
+    """Picks replicas by power of two choices over EWMA latency and outstanding requests.
+
+    A replica that fails `failure_threshold` times in a row is ejected for
+    `open_seconds` (doubling up to `max_open_seconds` while it keeps failing),
+    then gets a single probe request before it takes traffic again.
+    """
+
+    def __init__(self, ewma_alpha=0.3, failure_threshold=5, open_seconds=10, max_open_seconds=300):
+        self.__alpha = ewma_alpha
+        self.__failure_threshold = failure_threshold
+        self.__open_seconds = open_seconds
+        self.__max_open_seconds = max_open_seconds
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, url):
+        stats = self.__stats.get(url)
+        if stats is None:
+            stats = self.__stats[url] = ReplicaStats()
+        return stats
+
+    def __available(self, stats, now):
+        return stats.state == CLOSED or now - stats.opened_at >= stats.open_seconds
+
+    def __score(self, stats):
+        # a replica that fails fast must not look like a fast one
+        return (stats.latency or 0) * (stats.outstanding + 1) / max(1 - stats.error_rate, 0.01)
+
+    def choose(self, replicas, exclude=None):
+        candidates = [r for r in replicas if r['url'] != exclude]
+        if not candidates:
+            return None
+
+        now = time.time()
+        with self.__lock:
+            available = [r for r in candidates if self.__available(self.__get(r['url']), now)]
+            if not available:
+                return random.choice(candidates)
+            if len(available) == 1:
+                chosen = available[0]
+            else:
+                a, b = random.sample(available, 2)
+                chosen = a if self.__score(self.__get(a['url'])) <= self.__score(self.__get(b['url'])) else b
+
+            stats = self.__get(chosen['url'])
+            if stats.state != CLOSED:
+                stats.state = HALF_OPEN
+                stats.opened_at = now
+        return chosen
+
+    def on_start(self, url):
+        with self.__lock:
+            self.__get(url).outstanding += 1
+
+    def on_finish(self, url, latency, ok):
+        with self.__lock:
+            stats = self.__get(url)
+            stats.outstanding = max(stats.outstanding - 1, 0)
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.__alpha * (latency - stats.latency)
+            stats.error_rate += self.__alpha * ((0 if ok else 1) - stats.error_rate)
+
+            if ok:
+                stats.consecutive_failures = 0
+                stats.state = CLOSED
+                return
+
+            stats.consecutive_failures += 1
+            if stats.state == HALF_OPEN:
+                stats.state = OPEN
+                stats.opened_at = time.time()
+                stats.open_seconds = min(stats.open_seconds * 2, self.__max_open_seconds)
+            elif stats.state == CLOSED and stats.consecutive_failures >= self.__failure_threshold:
+                stats.state = OPEN
+                stats.opened_at = time.time()
+                stats.open_seconds = self.__open_seconds
+
+    def retain(self, urls):
+        urls = set(urls)
+        with self.__lock:
+            self.__stats = {url: stats for url, stats in self.__stats.items() if url in urls}
+
+    def stats(self):
+        with self.__lock:
+            return {url: dict(vars(stats)) for url, stats in self.__stats.items()}
@@ -0,0 +1,116 @@
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+import torch
+
+import model_api
+
+
+logger = logging.getLogger('batch_eval')
+
+TEST_QS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'training_stuff_and_notebooks', 'train_with_gpt', 'train', 'test_qs.txt')
+
+
+def read_questions(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def answered_count(path):
+    """Number of complete rows in `path`; a row cut by an interruption is dropped."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            f.truncate(complete)
+    return data[:complete].count(b'\n')
+
+
+def write_row(writer, question, answer, ok):
+    # the notebooks wrote "question;answer;", rejected answers are marked in the last column;
+    # fields with a ';' are quoted
+    writer.writerow([question, answer, '' if ok else 'rejected'])
+
+
+def init_worker(config):
+    np.random.seed(42)
+    torch.manual_seed(42)
+    model_api.load(config, serve=False)
+
+
+def answer_chunk(questions):
+    """Answers with the prompt format of model_api, in batches of max_batch_size."""
+    batch_size = model_api.CONFIG.get('max_batch_size', 1)
+    results = []
+    for batch in chunks(questions, batch_size):
+        results += model_api.answer_batch([(model_api.build_prompt(q, []), None, None, None) for q in batch])
+    return questions, results
+
+
+def main():
+    parser = argparse.ArgumentParser('Answers a file of questions with a model config, e.g. to produce test_ans40.csv')
+    parser.add_argument('--config-path', help='model config, as for model_api')
+    parser.add_argument('--input', default=TEST_QS_PATH, help='questions, one per line')
+    parser.add_argument('--output', required=True, help='csv of question;answer; rows, appended to if it exists')
+    parser.add_argument('--processes', type=int, help='model processes, cores / threads per process by default')
+    parser.add_argument('--threads', type=int, default=2, help='torch threads per process')
+    parser.add_argument('--chunk-size', type=int, default=32, help='questions sent to a process at once')
+    parser.add_argument('--num-candidates', type=int, help='override num_candidates of the config')
+    parser.add_argument('--restart', action='store_true', help='overwrite the output instead of resuming it')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.config_path) as f:
+        config = json.load(f)
+    config.setdefault('inference', {}).update({'intra_op_threads': args.threads, 'inter_op_threads': 1})
+    if args.num_candidates:
+        config['num_candidates'] = args.num_candidates
+    processes = args.processes or max((os.cpu_count() or 1) // args.threads, 1)
+
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    done = answered_count(args.output)
+    if done:
+        logger.info('Resuming after %s answered questions', done)
+    questions = itertools.islice(read_questions(args.input), done, None)
+
+    started = time.time()
+    answered = rejected = 0
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(config,)) as pool, \
+            open(args.output, 'a', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out, delimiter=';', lineterminator='\n')
+        # imap keeps the input order, so the output stays a prefix of the input and can be resumed
+        for chunk_questions, results in pool.imap(answer_chunk, chunks(questions, args.chunk_size)):
+            for question, (answer, ok) in zip(chunk_questions, results):
+                write_row(writer, question, answer, ok)
+                rejected += not ok
+            out.flush()
+            answered += len(chunk_questions)
+            logger.info('Answered %s questions, %.1f per second, %s rejected',
+                        done + answered, answered / (time.time() - started), rejected)
+
+
+if __name__ == '__main__':
+    main()
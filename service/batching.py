@@ -0,0 +1,123 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+from metrics import Counter, Histogram
+
+
+BATCH_SIZE = Histogram('batch_size', 'Items per processed batch', ['batcher'], buckets=(1, 2, 4, 8, 16, 32, 64))
+EXPIRED = Counter('batch_expired_total', 'Items dropped from the queue after their deadline', ['batcher'])
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _Entry:
+    __slots__ = ('item', 'future', 'deadline')
+
+    def __init__(self, item, future, deadline):
+        self.item = item
+        self.future = future
+        self.deadline = deadline
+
+
+class MicroBatcher:
+    """Collects concurrent calls into batches for a single worker thread.
+
+    `process` takes a list of items and returns a list of results of the same
+    length. A batch is closed when it has `max_batch_size` items or when
+    `max_wait` seconds passed since its first item arrived.
+
+    Calls submitted with the same `key` while an earlier one is still in
+    flight share its future instead of being processed again, and the
+    shared call keeps the latest of their deadlines. Calls whose
+    `deadline` (a time.time() value) passed while they were queued are
+    failed with DeadlineExceeded instead of being processed.
+    """
+
+    def __init__(self, process, max_batch_size=8, max_wait=0.005, name='MicroBatcher', logger=None):
+        self.__process = process
+        self.__max_batch_size = max_batch_size
+        self.__max_wait = max_wait
+        self.__queue = queue.Queue()
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+        self.__name = name
+        self.__logger = logger or logging.getLogger(name)
+
+        self.__thread = threading.Thread(target=self.__loop, name=name)
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def submit(self, item, key=None, deadline=None):
+        entry = _Entry(item, Future(), deadline)
+        if key is not None:
+            with self.__lock:
+                shared = self.__in_flight.get(key)
+                if shared is not None:
+                    # a later caller may wait longer, or without a deadline at all
+                    if shared.deadline is not None:
+                        shared.deadline = None if deadline is None else max(shared.deadline, deadline)
+                    return shared.future
+                self.__in_flight[key] = entry
+            entry.future.add_done_callback(lambda _: self.__forget(key))
+
+        self.__queue.put(entry)
+        return entry.future
+
+    @property
+    def queue_size(self):
+        return self.__queue.qsize()
+
+    def __forget(self, key):
+        with self.__lock:
+            self.__in_flight.pop(key, None)
+
+    def __alive(self, entry):
+        with self.__lock:
+            expired = entry.deadline is not None and entry.deadline <= time.time()
+        if expired:
+            EXPIRED.inc(batcher=self.__name)
+            entry.future.set_exception(DeadlineExceeded())
+            return False
+        return True
+
+    def __collect(self):
+        entry = self.__queue.get()
+        while not self.__alive(entry):
+            entry = self.__queue.get()
+        batch = [entry]
+        deadline = time.time() + self.__max_wait
+        while len(batch) < self.__max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                entry = self.__queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if self.__alive(entry):
+                batch.append(entry)
+        return [(entry.item, entry.future) for entry in batch]
+
+    def __loop(self):
+        while True:
+            batch = self.__collect()
+            items = [item for item, _ in batch]
+            BATCH_SIZE.observe(len(items), batcher=self.__name)
+            try:
+                results = self.__process(items)
+            except Exception as e:
+                self.__logger.exception('Exception while processing batch of %s: %s', len(items), repr(e))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
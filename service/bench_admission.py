@@ -0,0 +1,91 @@
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import main_api
+from stub_backends import StubProcess
+from bench_utils import percentile
+
+
+MODES = {
+    'static': {'max_in_flight': 1000, 'max_in_flight_for_uid': 10},
+    'adaptive': {
+        'max_in_flight': 1000, 'max_in_flight_for_uid': 10,
+        'adaptive': {'initial_limit': 20, 'min_limit': 2, 'tolerance': 2.0},
+    },
+}
+
+
+def run_open_loop(rps, duration, uids, slo):
+    """Sends `rps` requests per second for `duration` seconds regardless of how fast they are answered."""
+    stats = {'sent': 0, 'good': 0, 'fallback': 0, 'rejected': 0, 'slow': 0}
+    latencies = []
+    lock = threading.Lock()
+    client = main_api.app.test_client()
+
+    def call(i):
+        started = time.time()
+        r = client.post('/api', json={'uid': str(random.randrange(uids)), 'query': 'привет {}'.format(i)})
+        elapsed = time.time() - started
+        with lock:
+            if r.status_code == 429:
+                stats['rejected'] += 1
+                return
+            latencies.append(elapsed)
+            if json.loads(r.data)['from'] == 'fallback':
+                stats['fallback'] += 1
+            elif elapsed > slo:
+                stats['slow'] += 1
+            else:
+                stats['good'] += 1
+
+    executor = ThreadPoolExecutor(max_workers=int(rps * 10))
+    started = time.time()
+    i = 0
+    while time.time() - started < duration:
+        executor.submit(call, i)
+        i += 1
+        time.sleep(max(started + i / rps - time.time(), 0))
+    executor.shutdown(wait=True)
+
+    stats['sent'] = i
+    stats['goodput'] = stats['good'] / duration
+    stats['p50_ms'] = percentile(latencies, 0.5) * 1000
+    stats['p99_ms'] = percentile(latencies, 0.99) * 1000
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser('Goodput of the aggregator under overload with static and adaptive admission control')
+    parser.add_argument('--rps', type=float, default=60, help='offered load')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per mode')
+    parser.add_argument('--uids', type=int, default=1000, help='number of simulated users')
+    parser.add_argument('--capacity', type=int, default=4, help='requests the stub model serves at once')
+    parser.add_argument('--latency-ms', type=float, default=100, help='stub model latency')
+    parser.add_argument('--timeout', type=float, default=3, help='aggregator timeout for the stub model')
+    parser.add_argument('--slo', type=float, default=1.5, help='answers slower than this do not count as goodput')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    stub = StubProcess('model-40', latency=args.latency_ms / 1000, capacity=args.capacity).start()
+    print('stub capacity is about {:.0f} rps'.format(args.capacity / (args.latency_ms / 1000)))
+
+    for name, quota_conf in MODES.items():
+        main_api.SERVICES.update([stub.service_conf(priority=4, timeout=args.timeout)])
+        main_api.USER_QUOTAS = main_api.UserQuoatas()
+        main_api.USER_QUOTAS.update(quota_conf)
+        stats = run_open_loop(args.rps, args.duration, args.uids, args.slo)
+        print('{:<9} goodput {:6.1f} rps  sent {}  good {}  slow {}  fallback {}  429 {}  p50 {:.0f}ms  p99 {:.0f}ms'.format(
+            name, stats['goodput'], stats['sent'], stats['good'], stats['slow'], stats['fallback'], stats['rejected'],
+            stats['p50_ms'], stats['p99_ms']))
+        time.sleep(args.timeout)
+
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
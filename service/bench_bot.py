@@ -0,0 +1,80 @@
+import sys
+import time
+import random
+import argparse
+import subprocess
+
+import requests
+
+from stub_backends import StubTelegram, StubProcess, free_port
+from bench_utils import SERVICE_DIR, load_questions, percentile, start_service
+
+
+ERROR_REPLY = 'Что-то пошло не так :('
+
+
+def run(registry_url, messages, args, workers, webhook):
+    webhook_port = free_port()
+    webhook_url = 'http://127.0.0.1:{}/webhook'.format(webhook_port) if webhook else None
+    telegram = StubTelegram(messages, args.rps, webhook_url=webhook_url).start()
+
+    bot_args = ['bot.py', '--telegram_token', '123:stub', '--service_registry_url', registry_url,
+                '--workers', str(workers), '--timeout', str(args.timeout), '--telegram_api_url', telegram.api_url]
+    if webhook:
+        bot_args += ['--webhook_url', webhook_url, '--webhook_host', '127.0.0.1', '--webhook_port', str(webhook_port)]
+        bot = start_service(bot_args, webhook_port)
+    else:
+        bot = subprocess.Popen([sys.executable] + bot_args, cwd=SERVICE_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(2)
+
+    started = time.time()
+    telegram.send_all()
+    telegram.wait_replies(args.timeout + 60)
+    elapsed = time.time() - started
+    bot.kill()
+    telegram.stop()
+
+    latencies = telegram.latencies
+    return {
+        'answered': len(telegram.replies), 'errors': telegram.replies.count(ERROR_REPLY),
+        'rps': len(telegram.replies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser('Load test of the Telegram front end against stub Telegram API and aggregator')
+    parser.add_argument('--messages', type=int, default=300, help='number of messages')
+    parser.add_argument('--users', type=int, default=100, help='number of simulated users')
+    parser.add_argument('--rps', type=float, default=30, help='messages per second')
+    parser.add_argument('--latency-ms', type=float, default=300, help='stub aggregator latency')
+    parser.add_argument('--jitter-ms', type=float, default=1500, help='stub aggregator extra random latency')
+    parser.add_argument('--timeout', type=float, default=10, help='bot timeout for the aggregator')
+    parser.add_argument('--workers', default='1,64', help='comma separated worker pool sizes to compare')
+    parser.add_argument('--webhook', action='store_true', help='push updates to a webhook instead of long polling')
+    args = parser.parse_args()
+
+    random.seed(42)
+    questions = load_questions()
+    messages = [(random.randrange(args.users) + 1, random.choice(questions)) for _ in range(args.messages)]
+
+    registry_port = free_port()
+    registry = start_service(['service_registry_api.py', '--port', str(registry_port)], registry_port)
+    registry_url = 'http://127.0.0.1:{}'.format(registry_port)
+    aggregator = StubProcess('aggregator', latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000).start()
+    requests.post(registry_url + '/register', json=aggregator.service_conf(priority=6))
+
+    try:
+        for workers in args.workers.split(','):
+            stats = run(registry_url, messages, args, int(workers), args.webhook)
+            print('{:<8} workers {:>3}  answered {:4d}  errors {:3d}  rps {:5.1f}  p50 {:6.0f}ms  p99 {:6.0f}ms'.format(
+                'webhook' if args.webhook else 'polling', workers, stats['answered'], stats['errors'], stats['rps'],
+                stats['p50_ms'], stats['p99_ms']))
+    finally:
+        aggregator.stop()
+        registry.kill()
+
+
+if __name__ == '__main__':
+    main()
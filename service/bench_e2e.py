@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stub_backends import StubProcess, free_port
+from bench_utils import SERVICE_DIR, load_questions, percentile, start_service
+
+
+# the services of aggregator/config.json, with latencies roughly like the real ones
+DEFAULT_SCENARIO = [
+    {'name': 'wiki', 'priority': 5, 'timeout': 6, 'history_len': 0, 'failure_rate': 0.7,
+     'latency': {'distribution': 'lognormal', 'latency': 0.4, 'jitter': 0.5}},
+    {'name': 'model-40', 'priority': 4, 'timeout': 5, 'history_len': 1, 'replicas': 2, 'failure_rate': 0.1,
+     'latency': {'distribution': 'lognormal', 'latency': 1.0, 'jitter': 0.4}, 'capacity': 8},
+    {'name': 'model-30', 'priority': 3, 'timeout': 5, 'history_len': 0, 'failure_rate': 0.1,
+     'latency': {'distribution': 'lognormal', 'latency': 0.8, 'jitter': 0.4}, 'capacity': 8},
+    {'name': 'model-20', 'priority': 2, 'timeout': 5, 'history_len': 0, 'failure_rate': 0.1,
+     'latency': {'distribution': 'exponential', 'latency': 0.3, 'jitter': 0.2}, 'capacity': 8},
+]
+
+
+def start_backends(scenario):
+    stubs = []
+    for backend in scenario:
+        for _ in range(backend.get('replicas', 1)):
+            stub = StubProcess(backend['name'], failure_rate=backend.get('failure_rate', 0),
+                               capacity=backend.get('capacity'), **backend.get('latency', {}))
+            stubs.append((stub.start(), backend))
+    return stubs
+
+
+def aggregator_config(base_config_path, stubs, registry_url, port, workdir):
+    with open(base_config_path) as f:
+        config = json.load(f)
+
+    config['service_conf'] = [
+        stub.service_conf(backend['priority'], backend['timeout'], backend['history_len']) for stub, backend in stubs]
+    config['service_registry']['url'] = registry_url
+    config['service_registry']['conf']['url'] = 'http://127.0.0.1:{}/api'.format(port)
+    config['service_registry']['services_names'] = sorted({backend['name'] for _, backend in stubs})
+    config.get('chat_history', {}).pop('snapshot_path', None)
+
+    path = os.path.join(workdir, 'aggregator.json')
+    with open(path, 'w') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    return path
+
+
+def replay(url, questions, rps, duration, uids, slo):
+    """Sends `rps` requests per second for `duration` seconds regardless of how fast they are answered."""
+    counts = {'sent': 0, 'good': 0, 'slow': 0, 'fallback': 0, 'rejected': 0, 'errors': 0}
+    latencies = []
+    sources = {}
+    lock = threading.Lock()
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=int(rps * 10)))
+
+    def call(i):
+        started = time.time()
+        try:
+            r = session.post(url, json={'uid': str(random.randrange(uids)), 'query': questions[i % len(questions)]},
+                             timeout=30)
+            elapsed = time.time() - started
+            reply = r.json() if r.status_code == 200 else None
+        except Exception:
+            with lock:
+                counts['errors'] += 1
+            return
+
+        with lock:
+            if r.status_code == 429:
+                counts['rejected'] += 1
+                return
+            if reply is None:
+                counts['errors'] += 1
+                return
+            latencies.append(elapsed)
+            sources[reply.get('from')] = sources.get(reply.get('from'), 0) + 1
+            if reply.get('from') == 'fallback':
+                counts['fallback'] += 1
+            elif elapsed > slo:
+                counts['slow'] += 1
+            else:
+                counts['good'] += 1
+
+    executor = ThreadPoolExecutor(max_workers=int(rps * 10))
+    started = time.time()
+    i = 0
+    while time.time() - started < duration:
+        executor.submit(call, i)
+        i += 1
+        time.sleep(max(started + i / rps - time.time(), 0))
+    executor.shutdown(wait=True)
+
+    counts['sent'] = i
+    sent = max(i, 1)
+    return {
+        'counts': counts, 'sources': sources,
+        'offered_rps': i / duration,
+        'goodput_rps': counts['good'] / duration,
+        'fallback_rate': counts['fallback'] / sent,
+        'rejected_rate': counts['rejected'] / sent,
+        'error_rate': counts['errors'] / sent,
+        'latency_ms': {name: percentile(latencies, p) * 1000 for name, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVICE_DIR).decode().strip()
+    except Exception:
+        return None
+
+
+def print_result(result, baseline=None):
+    def line(name, key, fmt):
+        value = key(result)
+        text = '{:<14}'.format(name) + fmt.format(value)
+        if baseline is not None:
+            text += ('  (was ' + fmt + ')').format(key(baseline))
+        print(text)
+
+    print('commit {}  offered {:.1f} rps  sent {}'.format(
+        result['commit'], result['offered_rps'], result['counts']['sent']))
+    line('goodput', lambda r: r['goodput_rps'], '{:8.1f} rps')
+    for p in ('p50', 'p95', 'p99'):
+        line(p, lambda r, p=p: r['latency_ms'][p], '{:8.0f} ms')
+    line('fallback', lambda r: r['fallback_rate'] * 100, '{:8.1f} %')
+    line('429', lambda r: r['rejected_rate'] * 100, '{:8.1f} %')
+    line('errors', lambda r: r['error_rate'] * 100, '{:8.1f} %')
+    print('answered by   ', ', '.join('{} {}'.format(k, v) for k, v in sorted(result['sources'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser('End-to-end load test: registry, aggregator and stub backends on this host')
+    parser.add_argument('--rps', type=float, default=20, help='offered load')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of load before measuring')
+    parser.add_argument('--uids', type=int, default=1000, help='number of simulated users')
+    parser.add_argument('--slo', type=float, default=3, help='answers slower than this do not count as goodput')
+    parser.add_argument('--scenario', help='json list of backends like DEFAULT_SCENARIO')
+    parser.add_argument('--base-config', default=os.path.join(SERVICE_DIR, 'aggregator', 'config.json'),
+                        help='aggregator config to take quotas, balancing, fan-out and history settings from')
+    parser.add_argument('--output', help='write the results as json here')
+    parser.add_argument('--compare', help='results json of an earlier run to compare with')
+    args = parser.parse_args()
+
+    scenario = DEFAULT_SCENARIO
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = json.load(f)
+    random.seed(42)
+    questions = load_questions()
+    random.shuffle(questions)
+
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    registry_port = free_port()
+    registry_url = 'http://127.0.0.1:{}'.format(registry_port)
+    registry = start_service(['service_registry_api.py', '--port', str(registry_port)], registry_port)
+    stubs = start_backends(scenario)
+    aggregator = None
+    try:
+        for stub, backend in stubs:
+            requests.post(registry_url + '/register',
+                          json=stub.service_conf(backend['priority'], backend['timeout'], backend['history_len']))
+
+        port = free_port()
+        config_path = aggregator_config(args.base_config, stubs, registry_url, port, workdir)
+        aggregator = start_service(['main_api.py', '--config-path', config_path, '--port', str(port)], port)
+        url = 'http://127.0.0.1:{}/api'.format(port)
+
+        if args.warmup:
+            replay(url, questions, args.rps, args.warmup, args.uids, args.slo)
+        result = replay(url, questions, args.rps, args.duration, args.uids, args.slo)
+    finally:
+        if aggregator is not None:
+            aggregator.kill()
+        for stub, _ in stubs:
+            stub.stop()
+        registry.kill()
+
+    result.update({'commit': git_commit(), 'time': time.time(), 'args': vars(args), 'scenario': scenario})
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_result(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import threading
+
+import requests
+
+import main_api
+from fanout import FanOut
+from stub_backends import StubProcess
+from bench_utils import run_concurrently, format_stats
+
+
+class ThreadWithReturnValue(threading.Thread):
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}):
+        threading.Thread.__init__(self, group, target, name, args, kwargs)
+        self._return = None
+
+    def run(self):
+        try:
+            if self._target:
+                self._return = self._target(*self._args, **self._kwargs)
+        finally:
+            del self._target, self._args, self._kwargs
+
+    def get_return(self):
+        return self._return
+
+
+def legacy_fetch(url, data, timeout):
+    try:
+        return requests.post(url, json=data, timeout=timeout).json()
+    except Exception as e:
+        return {'ok': False, 'error': repr(e)}
+
+
+def legacy_fetch_all(calls):
+    """Thread-per-backend path that `main_api.fetch_all` used before FanOut."""
+    threads = []
+    for service, data in calls:
+        kw = {'url': service['url'], 'data': data, 'timeout': service['timeout']}
+        threads.append(ThreadWithReturnValue(target=legacy_fetch, kwargs=kw))
+
+    for t in threads:
+        t.start()
+
+    results = []
+    for (service, _), t in zip(calls, threads):
+        t.join(timeout=service['timeout'])
+        result = t.get_return()
+        if result is not None:
+            result['priority'] = service['priority']
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark of aggregator fan-out against local stub backends')
+    parser.add_argument('--backends', type=int, default=5, help='number of stub backends')
+    parser.add_argument('--latency-ms', type=float, default=20, help='stub backend latency')
+    parser.add_argument('--requests', type=int, default=2000, help='number of /api calls to emulate')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent callers')
+    parser.add_argument('--workers', type=int, default=256, help='FanOut workers')
+    args = parser.parse_args()
+
+    main_api.app.logger.disabled = True
+    backends = [StubProcess('stub-{}'.format(i), latency=args.latency_ms / 1000).start() for i in range(args.backends)]
+    services = [b.service_conf(priority=i) for i, b in enumerate(backends)]
+
+    fanout = FanOut(workers=args.workers, pool_size=args.concurrency, logger=main_api.app.logger)
+    modes = [('thread-per-request', legacy_fetch_all), ('pooled', fanout.fetch_all)]
+    for name, fetch_all in modes:
+        fetch_all([(s, {'uid': 'warmup', 'query': '', 'history': []}) for s in services])
+
+        def call(worker_id, i):
+            data = {'uid': str(worker_id), 'query': 'привет {}'.format(i), 'history': []}
+            results = fetch_all([(s, data) for s in services])
+            return sum(1 for r in results if r and not r['ok'])
+
+        latencies, errors, elapsed = run_concurrently(call, range(args.requests), args.concurrency)
+        print('{}  backend errors {}'.format(format_stats(name, args.requests, latencies, elapsed), sum(errors)))
+
+    fanout.close()
+    for b in backends:
+        b.stop()
+
+
+if __name__ == '__main__':
+    main()
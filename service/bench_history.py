@@ -0,0 +1,87 @@
+import gc
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+from collections import defaultdict, deque
+
+from history import ChatHistory
+
+
+class LegacyChatHistory:
+    """ChatHistory as main_api had it before history.py."""
+
+    def __init__(self, max_length=10):
+        self.__history = defaultdict(lambda : deque(maxlen=max_length))
+        self.__lock = threading.Lock()
+
+    def get_history(self, uid, max_length):
+        if not max_length:
+            return
+
+        with self.__lock:
+            history = list(self.__history[uid])
+        if max_length > len(history):
+            return history
+        return history[-max_length:]
+
+    def add_history(self, uid, *texts):
+        with self.__lock:
+            for text in texts:
+                self.__history[uid].append(text)
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def run(mode, users, turns, max_users, queue):
+    random.seed(42)
+    phrases = ['привет', 'как дела?', 'Нормально!', 'что делаешь?', 'Даже не знаю...', 'где ты?', 'Когда-то!']
+    gc.collect()
+    before = rss_bytes()
+
+    if mode == 'legacy':
+        history = LegacyChatHistory()
+    else:
+        history = ChatHistory(max_users=max_users)
+
+    started = time.time()
+    for turn in range(turns):
+        for uid in range(users):
+            history.add_history(str(uid), random.choice(phrases), random.choice(phrases))
+    fill_seconds = time.time() - started
+
+    started = time.time()
+    for uid in random.sample(range(users), min(users, 100000)):
+        history.get_history(str(uid), 10)
+    get_seconds = time.time() - started
+
+    gc.collect()
+    queue.put({
+        'mode': mode, 'rss_mb': (rss_bytes() - before) / 1024 / 1024, 'fill_seconds': fill_seconds,
+        'get_us': get_seconds / min(users, 100000) * 1e6,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser('Memory of chat history with many synthetic users')
+    parser.add_argument('--users', type=int, default=1000000, help='number of synthetic users')
+    parser.add_argument('--turns', type=int, default=3, help='query/reply pairs per user')
+    parser.add_argument('--max-users', type=int, default=250000, help='max_users of the bounded store')
+    args = parser.parse_args()
+
+    for mode in ('legacy', 'bounded'):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(mode, args.users, args.turns, args.max_users, queue))
+        process.start()
+        stats = queue.get()
+        process.join()
+        print('{:<8} rss +{:7.1f}MB  fill {:5.1f}s  get_history {:5.2f}us'.format(
+            stats['mode'], stats['rss_mb'], stats['fill_seconds'], stats['get_us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import copy
+import json
+import time
+import argparse
+import difflib
+
+import torch
+
+import model_api
+from inference import BACKENDS, configure_threads
+from bench_utils import load_questions, percentile
+
+
+def run_mode(config, backend, questions):
+    config = copy.deepcopy(config)
+    config['inference'] = dict(config.get('inference', {}), backend=backend)
+    config['num_candidates'] = 1
+    config['do_sample'] = False
+    model_api.load(config, serve=False)
+
+    answers = []
+    latencies = []
+    tokens = 0
+    for q in questions:
+        started = time.time()
+        answer = model_api.generate_answers([(model_api.build_prompt(q, []), None, None, None)])[0][0]
+        latencies.append(time.time() - started)
+        tokens += len(model_api.TOK.encode(answer))
+        answers.append(answer)
+
+    passed = model_api.RESULT_VALIDATION.validate_batch(answers)
+    return answers, {
+        'tokens_per_sec': tokens / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'validation_pass_rate': sum(passed) / len(passed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser('Speed and quality of the GPT inference backends on test_qs.txt')
+    parser.add_argument('--config-path', help='gpt_model config path')
+    parser.add_argument('--limit', type=int, default=None, help='use only the first questions')
+    parser.add_argument('--output-dir', default=None, help='where to write test_ans_<backend>.csv')
+    args = parser.parse_args()
+
+    with open(args.config_path) as f:
+        config = json.load(f)
+    model_api.app.logger.disabled = True
+    # thread pools are sized once for all modes, load would set them again for every one
+    inference_conf = config.setdefault('inference', {})
+    configure_threads(inference_conf.pop('intra_op_threads', None), inference_conf.pop('inter_op_threads', None))
+    questions = load_questions()[:args.limit]
+
+    answers = {}
+    for backend in BACKENDS:
+        torch.manual_seed(42)
+        answers[backend], stats = run_mode(config, backend, questions)
+        print('{:<6} tokens/sec {:8.1f}  p50 {:7.1f}ms  p99 {:7.1f}ms  validation passed {:.1%}'.format(
+            backend, stats['tokens_per_sec'], stats['p50_ms'], stats['p99_ms'], stats['validation_pass_rate']))
+
+        if args.output_dir:
+            path = os.path.join(args.output_dir, 'test_ans_{}.csv'.format(backend))
+            with open(path, 'w', encoding='utf-8') as f:
+                for q, a in zip(questions, answers[backend]):
+                    f.write('{};{};\n'.format(q, a))
+
+    reference = answers['fp32']
+    for backend in BACKENDS[1:]:
+        same = sum(1 for a, b in zip(reference, answers[backend]) if a == b)
+        similarity = sum(difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(reference, answers[backend]))
+        print('{} vs fp32: identical answers {:.1%}, mean similarity {:.3f}'.format(
+            backend, same / len(questions), similarity / len(questions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import json
+import argparse
+
+import torch
+
+import model_api
+from batching import MicroBatcher
+from bench_utils import load_questions, run_concurrently, format_stats
+
+
+def main():
+    parser = argparse.ArgumentParser('CPU throughput/latency benchmark of batched GPT generation')
+    parser.add_argument('--config-path', help='gpt_model config path')
+    parser.add_argument('--requests', type=int, default=200, help='number of questions to answer')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent callers')
+    parser.add_argument('--batch-sizes', default='1,4,8,16', help='comma separated max_batch_size values')
+    parser.add_argument('--max-wait-ms', type=float, default=None, help='override max_batch_wait_ms')
+    args = parser.parse_args()
+
+    with open(args.config_path) as f:
+        config = json.load(f)
+    torch.manual_seed(42)
+    model_api.load(config)
+    model_api.app.logger.disabled = True
+
+    max_wait = args.max_wait_ms if args.max_wait_ms is not None else config.get('max_batch_wait_ms', 5)
+    questions = load_questions()
+    questions = (questions * (args.requests // len(questions) + 1))[:args.requests]
+
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        model_api.BATCHER = MicroBatcher(
+            model_api.answer_batch, max_batch_size=batch_size, max_wait=max_wait / 1000).start()
+        model_api.get_answer(questions[0], [])
+
+        latencies, _, elapsed = run_concurrently(
+            lambda worker_id, q: model_api.get_answer(q, []), questions, args.concurrency)
+        print(format_stats('batch {}'.format(batch_size), len(questions), latencies, elapsed))
+
+
+if __name__ == '__main__':
+    main()
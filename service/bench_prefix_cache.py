@@ -0,0 +1,61 @@
+import json
+import time
+import random
+import argparse
+
+import torch
+
+import model_api
+from cache import PrefixCache
+from bench_utils import load_questions, percentile
+
+
+def follow_up_latency(questions, history_len, max_new_tokens, use_cache, uid):
+    """Answers a turn after `history_len` messages, then times the follow-up turn that extends its prompt."""
+    history = [random.choice(questions) for _ in range(history_len)]
+    query = random.choice(questions)
+    reply = model_api.generate_answers([(model_api.build_prompt(query, history), max_new_tokens, None, uid)])[0][0]
+
+    prompt = model_api.build_prompt(random.choice(questions), history + [query, reply])
+    started = time.time()
+    model_api.generate_answers([(prompt, max_new_tokens, None, uid if use_cache else None)])
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser('Latency of follow-up turns with and without the per-uid prompt state cache')
+    parser.add_argument('--config-path', help='gpt_model config path')
+    parser.add_argument('--history-lens', default='1,2,3,4,5,6,7,8,9,10', help='messages before the cached turn')
+    parser.add_argument('--repeats', type=int, default=10, help='follow-up turns per history length and mode')
+    parser.add_argument('--max-new-tokens', type=int, default=16, help='generated tokens per turn')
+    parser.add_argument('--max-mb', type=float, default=512, help='memory budget of the cache')
+    args = parser.parse_args()
+
+    with open(args.config_path) as f:
+        config = json.load(f)
+    config['num_candidates'] = 1
+    torch.manual_seed(42)
+    random.seed(42)
+    model_api.load(config, serve=False)
+    model_api.app.logger.disabled = True
+    model_api.PREFIX_CACHE = PrefixCache(int(args.max_mb * 2 ** 20))
+    questions = load_questions()
+
+    print('{:>8} {:>12} {:>12} {:>8}'.format('history', 'no cache', 'cache', 'speedup'))
+    for history_len in [int(h) for h in args.history_lens.split(',')]:
+        latencies = {}
+        for use_cache in (False, True):
+            latencies[use_cache] = [
+                follow_up_latency(questions, history_len, args.max_new_tokens, use_cache, 'uid{}'.format(i))
+                for i in range(args.repeats)]
+        cold, warm = percentile(latencies[False], 0.5), percentile(latencies[True], 0.5)
+        print('{:>8} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x'.format(history_len, cold * 1000, warm * 1000, cold / warm))
+
+    stats = model_api.PREFIX_CACHE.stats()
+    # the first turns of the conversations are counted as misses too
+    print('hit ratio {:.2f}, {} reused tokens, {} entries, {:.1f}MB'.format(
+        stats['hit_ratio'], stats['reused_tokens'], stats['entries'], stats['memory_bytes'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
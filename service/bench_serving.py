@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import requests
+
+from stub_backends import free_port
+from bench_utils import SERVICE_DIR, load_questions, run_concurrently, format_stats
+
+
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids, stack = [], [pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack += children.get(pid, [])
+    return pids
+
+
+def memory_mb(pid):
+    """RSS and PSS of a process and its children; PSS splits shared pages between the processes sharing them."""
+    rss = pss = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/{}/smaps_rollup'.format(p)) as f:
+                for line in f:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+        except OSError:
+            continue
+    return rss / 1024, pss / 1024
+
+
+def start_model_api(config_path, workers, port, wait=300):
+    process = subprocess.Popen(
+        [sys.executable, 'model_api.py', '--config-path', config_path, '--port', str(port), '--workers', str(workers)],
+        cwd=SERVICE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        try:
+            if requests.get('http://127.0.0.1:{}/ready'.format(port), timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('model_api did not get ready')
+
+
+def main():
+    parser = argparse.ArgumentParser('RPS and memory of model_api: threaded dev server against pre-forked workers')
+    parser.add_argument('--config-path', help='model config, as for model_api')
+    parser.add_argument('--workers', default='0,2,4', help='comma separated worker counts, 0 is the dev server')
+    parser.add_argument('--requests', type=int, default=200, help='requests per mode')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight')
+    args = parser.parse_args()
+
+    questions = load_questions()
+    questions = (questions * (args.requests // len(questions) + 1))[:args.requests]
+    for workers in [int(w) for w in args.workers.split(',')]:
+        port = free_port()
+        process = start_model_api(args.config_path, workers, port)
+        try:
+            url = 'http://127.0.0.1:{}/api'.format(port)
+            # every worker has to be warm before measuring
+            time.sleep(2 + workers)
+            sessions = [requests.Session() for _ in range(args.concurrency)]
+            call = lambda worker_id, q: sessions[worker_id].post(url, json={'uid': str(worker_id), 'query': q, 'history': []})
+            latencies, _, elapsed = run_concurrently(call, questions, args.concurrency)
+            rss, pss = memory_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+        name = 'dev server' if not workers else 'prefork x{}'.format(workers)
+        print('{}  rss {:7.0f}MB  pss {:7.0f}MB'.format(format_stats(name, len(questions), latencies, elapsed), rss, pss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import requests
+
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_QS_PATH = os.path.join(SERVICE_DIR, '..', 'training_stuff_and_notebooks', 'train_with_gpt', 'train', 'test_qs.txt')
+
+
+def load_questions(path=TEST_QS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def run_concurrently(call, items, concurrency):
+    """Calls `call(worker_id, item)` for every item from `concurrency` threads.
+
+    Returns the latencies of the calls, their results and the wall time.
+    """
+    latencies = []
+    results = []
+    lock = threading.Lock()
+    items = iter(items)
+
+    def worker(worker_id):
+        while True:
+            with lock:
+                item = next(items, None)
+            if item is None:
+                return
+            started = time.time()
+            result = call(worker_id, item)
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                results.append(result)
+
+    started = time.time()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies, results, time.time() - started
+
+
+def format_stats(name, count, latencies, elapsed):
+    return '{:<20} rps {:8.1f}  p50 {:7.1f}ms  p99 {:7.1f}ms'.format(
+        name, count / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+
+
+def start_service(args, port, wait=30):
+    """Runs `python args...` from the service directory and waits until it listens on `port`."""
+    process = subprocess.Popen([sys.executable] + args, cwd=SERVICE_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        try:
+            requests.get('http://127.0.0.1:{}/'.format(port), timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} did not start'.format(args[0]))
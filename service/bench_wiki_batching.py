@@ -0,0 +1,61 @@
+import time
+import random
+import argparse
+import threading
+
+from batching import MicroBatcher
+from bench_utils import load_questions, run_concurrently, format_stats
+
+
+class StubKBQA:
+    """Costs `call_ms` per call plus `item_ms` per query and runs one call at a time, like a CPU-bound model."""
+
+    def __init__(self, call_ms, item_ms):
+        self.__call = call_ms / 1000
+        self.__item = item_ms / 1000
+        self.__lock = threading.Lock()
+
+    def __call__(self, queries):
+        with self.__lock:
+            time.sleep(self.__call + self.__item * len(queries))
+        return ['Not Found' for _ in queries]
+
+
+def load_model(args):
+    if args.stub:
+        return StubKBQA(args.stub_call_ms, args.stub_item_ms)
+    from deeppavlov import build_model, configs
+    return build_model(configs.kbqa.kbqa_cq_rus, load_trained=True)
+
+
+def main():
+    parser = argparse.ArgumentParser('Throughput of micro-batched KBQA under concurrent load')
+    parser.add_argument('--requests', type=int, default=500, help='number of queries')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent callers')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='share of queries repeating a recent one')
+    parser.add_argument('--batch-sizes', default='1,8,16,32', help='comma separated max_batch_size values')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='batch wait window')
+    parser.add_argument('--stub', action='store_true', help='use a stub model instead of deeppavlov kbqa_cq_rus')
+    parser.add_argument('--stub-call-ms', type=float, default=40, help='stub model cost per call')
+    parser.add_argument('--stub-item-ms', type=float, default=5, help='stub model cost per query')
+    args = parser.parse_args()
+
+    model = load_model(args)
+    questions = load_questions()
+    random.seed(42)
+    queries = []
+    for i in range(args.requests):
+        if queries and random.random() < args.duplicates:
+            queries.append(random.choice(queries[-args.concurrency:]))
+        else:
+            queries.append(questions[i % len(questions)])
+
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        batcher = MicroBatcher(model, max_batch_size=batch_size, max_wait=args.max_wait_ms / 1000).start()
+        latencies, _, elapsed = run_concurrently(
+            lambda worker_id, q: batcher.submit(q, key=q).result(), queries, args.concurrency)
+        print(format_stats('batch {}'.format(batch_size), len(queries), latencies, elapsed))
+
+
+if __name__ == '__main__':
+    main()
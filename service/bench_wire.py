@@ -0,0 +1,101 @@
+import copy
+import json
+import time
+import random
+import argparse
+
+import msgpack
+
+from wire import JSON, MSGPACK, SharedBody, Body, decode
+from bench_utils import load_questions
+
+
+def make_request(questions, history_turns):
+    history = []
+    for _ in range(history_turns):
+        history += [random.choice(questions), random.choice(questions)]
+    return {'uid': str(random.randrange(10 ** 9)), 'query': random.choice(questions)}, history
+
+
+def make_reply(questions):
+    return {'uid': '123456789', 'from': 'model-40', 'ok': True, 'reply': random.choice(questions)}
+
+
+def legacy_fan_out(data, history, history_lens, reply):
+    """What main_api and requests did per request: a deep copy and a json body per service, r.json() per reply."""
+    for history_len in history_lens:
+        body = copy.deepcopy(data)
+        body['history'] = history[-history_len:] if history_len else []
+        body['deadline'] = time.time() + 5
+        json.dumps(body, allow_nan=False).encode('utf-8')
+        json.loads(reply)
+
+
+def shared_fan_out(encoding):
+    def fan_out(data, history, history_lens, reply):
+        shared = SharedBody(data)
+        for history_len in history_lens:
+            body = Body(shared, history=history[-history_len:] if history_len else [])
+            body['deadline'] = time.time() + 5
+            body.encode(encoding)
+            decode(reply, encoding)
+    return fan_out
+
+
+def legacy_backend(body, reply):
+    json.loads(body)
+    json.dumps(reply, ensure_ascii=False)
+
+
+def msgpack_backend(body, reply):
+    msgpack.unpackb(body)
+    msgpack.packb(reply)
+
+
+def cpu_per_call(fn, args, rounds):
+    started = time.process_time()
+    for i in range(rounds):
+        fn(*args[i % len(args)])
+    return (time.process_time() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser('CPU cost of encoding one fan-out and its replies, json against msgpack')
+    parser.add_argument('--history-lens', default='0,0,10,0,0', help='history_len of every service of the fan-out')
+    parser.add_argument('--history-turns', type=int, default=10, help='turns of chat history the aggregator keeps')
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(42)
+    questions = load_questions()
+    history_lens = [int(h) for h in args.history_lens.split(',')]
+    requests = [make_request(questions, args.history_turns) for _ in range(100)]
+    replies = [make_reply(questions) for _ in range(100)]
+
+    print('fan-out to {} services, history_len {}'.format(len(history_lens), args.history_lens))
+    modes = [
+        ('deepcopy + json', legacy_fan_out, lambda r: json.dumps(r).encode('utf-8')),
+        ('shared json', shared_fan_out(JSON), lambda r: json.dumps(r, ensure_ascii=False).encode('utf-8')),
+        ('shared msgpack', shared_fan_out(MSGPACK), msgpack.packb),
+    ]
+    baseline = None
+    for name, fan_out, encode_reply in modes:
+        calls = [(data, history, history_lens, encode_reply(reply)) for (data, history), reply in zip(requests, replies)]
+        cost = cpu_per_call(fan_out, calls, args.rounds)
+        baseline = baseline or cost
+        print('aggregator  {:<16} {:7.1f} us/request  x{:.2f}'.format(name, cost * 1e6, baseline / cost))
+
+    history = requests[0][1]
+    backend_calls = {
+        'json': [(json.dumps(dict(data, history=history[-2:], deadline=time.time())).encode('utf-8'), reply)
+                 for (data, _), reply in zip(requests, replies)],
+        'msgpack': [(msgpack.packb(dict(data, history=history[-2:], deadline=time.time())), reply)
+                    for (data, _), reply in zip(requests, replies)],
+    }
+    for name, fn in (('json', legacy_backend), ('msgpack', msgpack_backend)):
+        cost = cpu_per_call(fn, backend_calls[name], args.rounds)
+        print('backend     {:<16} {:7.1f} us/request'.format(name, cost * 1e6))
+
+
+if __name__ == '__main__':
+    main()
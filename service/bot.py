@@ -1,49 +1,133 @@
+import flask
 import telebot
 import requests
 import argparse
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from flask import request
+from requests.adapters import HTTPAdapter
 
 
 from client import ServiceRegistryClient
+from hash_ring import HashRing
+from logs import setup_logging, add_logging_arguments, logging_conf_from_args
 
 logger = logging.getLogger('TelegramBot')
 
 class Bot:
-    def __init__(self, token, service_registry_url):
-        self.__chatbot_url = None
-        registry = ServiceRegistryClient(None, service_registry_url, services_names='aggregator',
-                                         callback=self.set_chatbot_url)
-        registry.update_services()
-        assert self.__chatbot_url, 'chatbot url has not been set'
-        self.__bot = telebot.TeleBot(token)
+    """Answers Telegram messages with the aggregator.
+
+    Updates come from long polling or from a local webhook server; either
+    way every message is answered on a pool of `workers` threads sharing
+    one keep-alive session, so a slow answer holds up only its own user.
+    At most `workers` more messages wait for a free worker, after that
+    reading new updates blocks.
+    """
+
+    def __init__(self, token, service_registry_url, workers=64, timeout=10):
+        self.__ring = HashRing()
+        self.__registry = ServiceRegistryClient(None, service_registry_url, services_names='aggregator',
+                                                callback=self.set_chatbot_url)
+        self.__registry.update_services()
+        assert len(self.__ring), 'chatbot url has not been set'
+        self.__token = token
+        self.__timeout = timeout
+        self.__bot = telebot.TeleBot(token, threaded=False)
+
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bot_worker')
+        self.__slots = threading.BoundedSemaphore(2 * workers)
 
     def set_chatbot_url(self, conf):
         logger.debug('Got conf from Service Registry %s', conf)
-        self.__chatbot_url = conf[0]['url']
+        ring = HashRing([s['url'] for s in conf])
+        if not len(ring):
+            # keep the last known aggregators rather than dropping every message
+            logger.warning('Service Registry has no aggregators')
+            return
+        self.__ring = ring
 
-    def start(self):
+    def chatbot_url(self, uid):
+        """Aggregator that keeps the history and the quotas of `uid`."""
+        return self.__ring.owner(uid)
 
-        @self.__bot.message_handler(content_types=['text'])
-        def get_text_messages(message):
-            logger.debug('Got message %s', message)
+    def on_message(self, message):
+        self.__slots.acquire()
+        try:
+            self.__executor.submit(self.answer, message).add_done_callback(lambda _: self.__slots.release())
+        except Exception:
+            self.__slots.release()
+            raise
+
+    def answer(self, message):
+        logger.debug('Got message %s', message)
+        started = time.time()
+        uid = str(message.from_user.id)
+        try:
+            r = self.__session.post(self.chatbot_url(uid), json={'uid': uid, 'query': message.text}, timeout=self.__timeout)
+            r.raise_for_status()
+            r = r.json()
+            logger.debug('Got reply for %s, %s - %s', message.from_user.id, message.text, r)
+            self.__bot.send_message(message.from_user.id, r['reply'])
+            logger.info('Answered', extra={'uid': uid, 'service': r.get('from'), 'latency': time.time() - started})
+        except Exception:
+            logger.exception('Exception during getting answer, uid %s, text %s', message.from_user.id, message.text,
+                             extra={'uid': uid, 'latency': time.time() - started})
             try:
-                r = requests.post(self.__chatbot_url, json={'uid': str(message.from_user.id), 'query': message.text}).json()
-                logger.debug('Got reply for %s, %s - %s', message.from_user.id, message.text, r)
-                self.__bot.send_message(message.from_user.id, r['reply'])
-            except Exception as e:
-                logger.exception('Exception during getting answer, uid %s, text %s', message.from_user.id, message.text)
                 self.__bot.send_message(message.from_user.id, "Что-то пошло не так :(")
+            except Exception:
+                logger.exception('Exception during sending error message, uid %s', message.from_user.id)
+
+    def start(self, webhook_url=None, host='0.0.0.0', port=None):
+        self.__registry.start()
+        self.__bot.message_handler(content_types=['text'])(self.on_message)
 
-        self.__bot.polling(none_stop=True, interval=0)
+        if webhook_url:
+            self.serve_webhook(webhook_url, host, port)
+        else:
+            self.__bot.remove_webhook()
+            self.__bot.polling(none_stop=True, interval=0)
+
+    def serve_webhook(self, webhook_url, host, port):
+        """Registers `webhook_url` with Telegram and serves its path locally, e.g. behind a TLS proxy."""
+        app = flask.Flask('TelegramBotWebhook')
+
+        def webhook():
+            update = telebot.types.Update.de_json(request.get_data().decode('utf-8'))
+            self.__bot.process_new_updates([update])
+            return ''
+
+        app.add_url_rule(urlparse(webhook_url).path or '/', 'webhook', webhook, methods=['POST'])
+        self.__bot.remove_webhook()
+        self.__bot.set_webhook(url=webhook_url)
+        app.run(host=host, port=port, threaded=True)
 
 def main():
     parser = argparse.ArgumentParser('Telegrab chit-chat bot')
     parser.add_argument('--telegram_token')
     parser.add_argument('--service_registry_url')
+    parser.add_argument('--workers', type=int, default=64, help='messages answered at once')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for the aggregator and Telegram')
+    parser.add_argument('--webhook_url', help='public url of the webhook; long polling is used without it')
+    parser.add_argument('--webhook_host', default='0.0.0.0', help='host the local webhook server listens on')
+    parser.add_argument('--webhook_port', type=int, default=8443, help='port the local webhook server listens on')
+    parser.add_argument('--telegram_api_url', help='Telegram Bot API url template, e.g. a local stub for load tests')
+    add_logging_arguments(parser)
     args = parser.parse_args()
+    setup_logging(logging_conf_from_args(args), 'bot', [telebot.logger])
+
+    telebot.apihelper.READ_TIMEOUT = args.timeout
+    if args.telegram_api_url:
+        telebot.apihelper.API_URL = args.telegram_api_url
 
-    bot = Bot(args.telegram_token, args.service_registry_url)
-    bot.start()
+    bot = Bot(args.telegram_token, args.service_registry_url, args.workers, args.timeout)
+    bot.start(args.webhook_url, args.webhook_host, args.webhook_port)
 
 
 if __name__ == '__main__':
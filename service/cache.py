@@ -0,0 +1,255 @@
+import re
+import json
+import time
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """Makes "Кто такой Пушкин?" and "кто такой пушкин" the same cache key."""
+    query = query.lower().replace('ё', 'е')
+    query = re.sub(r'[^\w\s]', ' ', query)
+    return ' '.join(query.split())
+
+
+class LRUCache:
+    """In-memory LRU of at most `max_size` entries, each with its own expiry time."""
+
+    def __init__(self, max_size, ttl=None):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self.__entries[key]
+                return default
+            self.__entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.__ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class SQLiteCache:
+    """On-disk key-value tier; several processes on one host can share the file."""
+
+    def __init__(self, path, timeout=1.0):
+        self.__path = path
+        self.__timeout = timeout
+        self.__local = threading.local()
+        with self.__connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+
+    def __connection(self):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.__path, timeout=self.__timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local.conn = conn
+        return conn
+
+    def get(self, key):
+        """Returns (value, expires_at), or None for a missing or expired key."""
+        row = self.__connection().execute(
+            'SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value, expires_at):
+        with self.__connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), expires_at))
+
+    def evict_expired(self):
+        with self.__connection() as conn:
+            conn.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+
+class AnswerCache:
+    """Two-tier cache: an LRU in memory in front of an optional SQLite file.
+
+    Answers equal to `negative_value` are kept only for `negative_ttl`
+    seconds, so a fixed knowledge base gets a chance to answer again soon.
+    """
+
+    def __init__(self, memory_size=100000, ttl=7 * 24 * 60 * 60, negative_ttl=60 * 60, negative_value=None, path=None):
+        self.__memory = LRUCache(memory_size)
+        self.__disk = SQLiteCache(path) if path else None
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__negative_value = negative_value
+
+        self.__lock = threading.Lock()
+        self.__counters = {'memory_hits': 0, 'disk_hits': 0, 'negative_hits': 0, 'misses': 0}
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    def get(self, key):
+        """Returns (found, value)."""
+        missing = object()
+        value = self.__memory.get(key, missing)
+        if value is not missing:
+            self.__count('memory_hits')
+        elif self.__disk is not None:
+            entry = self.__disk.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                self.__memory.put(key, value, expires_at - time.time())
+                self.__count('disk_hits')
+
+        if value is missing:
+            self.__count('misses')
+            return False, None
+        if value == self.__negative_value:
+            self.__count('negative_hits')
+        return True, value
+
+    def put(self, key, value):
+        ttl = self.__negative_ttl if value == self.__negative_value else self.__ttl
+        self.__memory.put(key, value, ttl)
+        if self.__disk is not None:
+            self.__disk.put(key, value, time.time() + ttl)
+
+    def evict_expired(self):
+        if self.__disk is not None:
+            self.__disk.evict_expired()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0
+        stats['memory_entries'] = len(self.__memory)
+        return stats
+
+
+class ResponseCache:
+    """Aggregator-side cache of backend answers that depend only on the query.
+
+    Services in `pooled_services` sample their answers, so up to
+    `pool_size` different answers are collected per query before the cache
+    starts serving them, picking one at random on every hit.
+    """
+
+    def __init__(self, max_size=100000, ttl=60 * 60, pool_size=3, pooled_services=()):
+        self.__entries = LRUCache(max_size, ttl)
+        self.__pool_size = pool_size
+        self.__pooled_services = set(pooled_services)
+
+        self.__lock = threading.Lock()
+        self.__counters = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def cacheable(service):
+        return not service['history_len']
+
+    def __size(self, name):
+        return self.__pool_size if name in self.__pooled_services else 1
+
+    def get(self, name, query):
+        """Returns a cached result of service `name` for `query`, or None."""
+        pool = self.__entries.get((name, normalize_query(query)))
+        with self.__lock:
+            if pool is None or len(pool) < self.__size(name):
+                self.__counters['misses'] += 1
+                return None
+            self.__counters['hits'] += 1
+        return dict(random.choice(pool))
+
+    def put(self, name, query, result):
+        key = (name, normalize_query(query))
+        with self.__lock:
+            pool = self.__entries.get(key)
+            if pool is None:
+                pool = []
+            elif len(pool) >= self.__size(name):
+                return
+            pool.append(result)
+            if len(pool) == 1:
+                self.__entries.put(key, pool)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+        stats['entries'] = len(self.__entries)
+        return stats
+
+
+class PrefixCache:
+    """Per-uid LRU of the model state (past key/values) after the last prompt of the uid.
+
+    A follow-up prompt that starts with the cached tokens only needs the
+    model to run over the tokens after them. Least recently used uids are
+    evicted while the states take more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.__max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__counters = {'hits': 0, 'misses': 0, 'reused_tokens': 0}
+
+    def get(self, uid, tokens):
+        """Returns (length, state) of the cached prefix of `tokens`, or (0, None)."""
+        with self.__lock:
+            entry = self.__entries.get(uid)
+            if entry is not None:
+                cached, state, _ = entry
+                if len(cached) <= len(tokens) and tuple(tokens[:len(cached)]) == cached:
+                    self.__entries.move_to_end(uid)
+                    self.__counters['hits'] += 1
+                    self.__counters['reused_tokens'] += len(cached)
+                    return len(cached), state
+            self.__counters['misses'] += 1
+            return 0, None
+
+    def put(self, uid, tokens, state, size):
+        with self.__lock:
+            previous = self.__entries.pop(uid, None)
+            if previous is not None:
+                self.__bytes -= previous[2]
+            if size > self.__max_bytes:
+                return
+            self.__entries[uid] = (tuple(tokens), state, size)
+            self.__bytes += size
+            while self.__bytes > self.__max_bytes:
+                _, (_, _, evicted) = self.__entries.popitem(last=False)
+                self.__bytes -= evicted
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats['entries'] = len(self.__entries)
+            stats['memory_bytes'] = self.__bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+        return stats
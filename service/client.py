@@ -22,17 +22,21 @@ def get_local_ip():
 class ServiceRegistryClient:
     def __init__(
             self, current_service_conf, service_registry_url,
-            services_names=None, callback=None, timeout=5, update_period=180, register_period=60, logger=None):
+            services_names=None, callback=None, timeout=5, update_period=180, register_period=60, logger=None,
+            ready=None, watch_timeout=30):
 
         self.__service_registry_url = service_registry_url
         self.__services_names = services_names
         self.__callback = callback
         self.__timeout = timeout
         self.__update_period = update_period
+        self.__watch_timeout = watch_timeout
+        self.__version = None
         self.__current_service_conf = current_service_conf
         if self.__current_service_conf:
             self.__current_service_conf['url'] = self.__current_service_conf['url'].replace('{ip}', get_local_ip())
         self.__register_period = register_period
+        self.__ready = ready
         self.__logger = logger or logging.getLogger('ServiceRegistryClient')
 
         self.__reg_thread = threading.Thread(target=self.try_register_service_loop, name='try_register_service_loop')
@@ -43,7 +47,8 @@ class ServiceRegistryClient:
             self.__update_thread.daemon = True
 
     def start(self):
-        self.__reg_thread.start()
+        if self.__current_service_conf:
+            self.__reg_thread.start()
         if self.__services_names and self.__callback:
             self.__update_thread.start()
 
@@ -56,12 +61,29 @@ class ServiceRegistryClient:
         try:
             self.update_services()
         except Exception as e:
-            self.__logger.exception('Exception while updating services {}', repr(e))
+            self.__logger.exception('Exception while updating services %s', repr(e))
+
+    def watch_services(self):
+        """Long-polls the registry and calls back only when its version changed."""
+        params = {'since': self.__version if self.__version is not None else -1, 'timeout': self.__watch_timeout}
+        r = requests.get(
+            self.__service_registry_url + '/watch', params=params, timeout=self.__watch_timeout + self.__timeout)
+        r.raise_for_status()
+        r = r.json()
+        if r['version'] == self.__version:
+            return
+        services = [s for s in r['services'] if s['name'] in self.__services_names]
+        self.__callback(services)
+        self.__version = r['version']
 
     def try_update_services_loop(self):
         while True:
-            self.try_update_services()
-            time.sleep(self.__update_period)
+            try:
+                self.watch_services()
+            except Exception as e:
+                self.__logger.exception('Exception while watching services %s', repr(e))
+                self.try_update_services()
+                time.sleep(min(self.__update_period, self.__register_period))
 
     def register_service(self):
         requests.post(self.__service_registry_url + '/register', json=self.__current_service_conf, timeout=self.__timeout)
@@ -70,9 +92,11 @@ class ServiceRegistryClient:
         try:
             self.register_service()
         except Exception as e:
-            self.__logger.exception('Exception while service register {}', repr(e))
+            self.__logger.exception('Exception while service register %s', repr(e))
 
     def try_register_service_loop(self):
+        while self.__ready and not self.__ready():
+            time.sleep(1)
         while True:
             self.try_register_service()
             time.sleep(self.__register_period)
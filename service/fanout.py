@@ -0,0 +1,238 @@
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+
+import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+from wire import ACCEPT, Body, decode, encoding_for
+
+
+BACKEND_LATENCY = Histogram('backend_request_seconds', 'Latency of backend calls', ['service'])
+BACKEND_ERRORS = Counter(
+    'backend_errors_total', 'Backend calls that failed, answered not ok or expired before they were sent',
+    ['service', 'reason'])
+BACKEND_ABANDONED = Counter(
+    'backend_abandoned_total', 'Backend calls whose result was not waited for', ['service', 'reason'])
+BACKEND_HEDGES = Counter('backend_hedges_total', 'Duplicate requests sent to another replica', ['service'])
+
+
+class LatencyTracker:
+    """Keeps the last `window` latencies of every service name."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.__min_samples = min_samples
+        self.__latencies = defaultdict(lambda: deque(maxlen=window))
+        self.__lock = threading.Lock()
+
+    def add(self, name, latency):
+        with self.__lock:
+            self.__latencies[name].append(latency)
+
+    def percentile(self, name, p):
+        with self.__lock:
+            latencies = sorted(self.__latencies[name])
+        if len(latencies) < self.__min_samples:
+            return None
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+
+class _Slot:
+    def __init__(self, service, data, started):
+        self.service = service
+        self.data = data
+        self.deadline = started + service['timeout']
+        self.hedge_at = None
+        self.futures = []
+        self.result = None
+        self.done = False
+
+
+class FanOut:
+    """Sends one request to every backend using a fixed pool of workers.
+
+    Every backend url gets its own `requests.Session` with a keep-alive
+    connection pool, so steady traffic reuses TCP connections instead of
+    doing a new handshake per call.
+
+    `hedging` enables duplicate requests for the listed service names:
+    {"services": ["model-40"], "percentile": 0.9, "window": 200, "min_samples": 20}
+
+    `observer.on_start(url)` and `observer.on_finish(url, latency, ok)` are
+    called around every backend call; `ok` is False for transport errors.
+
+    Request data is a dict or a wire.Body; a Body is sent in msgpack to the
+    services whose conf lists it in "encodings", in json to the rest.
+    """
+
+    def __init__(self, workers=256, pool_size=64, hedging=None, observer=None, logger=None):
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout')
+        self.__pool_size = pool_size
+        self.__sessions = {}
+        self.__lock = threading.Lock()
+        self.__observer = observer
+        self.__logger = logger or logging.getLogger('FanOut')
+
+        hedging = hedging or {}
+        self.__hedged_services = set(hedging.get('services', []))
+        self.__hedge_percentile = hedging.get('percentile', 0.9)
+        self.__latencies = LatencyTracker(hedging.get('window', 200), hedging.get('min_samples', 20))
+
+    def session(self, url):
+        session = self.__sessions.get(url)
+        if session is not None:
+            return session
+
+        with self.__lock:
+            session = self.__sessions.get(url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.__sessions[url] = session
+        return session
+
+    def fetch(self, url, data, timeout, encoding=None):
+        if isinstance(data, Body):
+            encoding = encoding or 'application/json'
+            r = self.session(url).post(url, data=data.encode(encoding), timeout=timeout,
+                                       headers={'Content-Type': encoding, 'Accept': ACCEPT})
+        else:
+            r = self.session(url).post(url, json=data, timeout=timeout, headers={'Accept': ACCEPT})
+        r.raise_for_status()
+        return decode(r.content, r.headers.get('Content-Type'))
+
+    def __call(self, service, data, deadline):
+        url = service['url']
+        # the call may have waited in the pool; it only gets what is left of the fan-out's timeout
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            BACKEND_ERRORS.inc(service=service['name'], reason='expired')
+            return {'ok': False, 'error': 'Deadline exceeded before the call was sent'}
+        if self.__observer:
+            self.__observer.on_start(url)
+        started = time.time()
+        ok = True
+        try:
+            self.__logger.debug('Starting %s with data %s', url, data)
+            result = self.fetch(url, data, timeout, encoding_for(service))
+            self.__logger.debug('Got for %s with data %s result %s', url, data, result, extra={
+                'uid': data.get('uid'), 'service': service['name'], 'latency': time.time() - started})
+            if not result.get('ok'):
+                BACKEND_ERRORS.inc(service=service['name'], reason='not_ok')
+        except Exception as e:
+            self.__logger.exception('Got for %s with data %s exception %s', url, data, repr(e), extra={
+                'uid': data.get('uid'), 'service': service['name'], 'latency': time.time() - started})
+            result = {'ok': False, 'error': repr(e)}
+            ok = False
+            reason = 'timeout' if isinstance(e, requests.Timeout) else 'error'
+            BACKEND_ERRORS.inc(service=service['name'], reason=reason)
+
+        latency = time.time() - started
+        BACKEND_LATENCY.observe(latency, service=service['name'])
+        self.__latencies.add(service['name'], latency)
+        if self.__observer:
+            self.__observer.on_finish(url, latency, ok)
+        return result
+
+    def submit(self, service, data, deadline):
+        """Calls `service` on a pool worker; `deadline` is a time.time() value, not a timeout."""
+        return self.__executor.submit(self.__call, service, data, deadline)
+
+    def fetch_all(self, calls, alternative=None):
+        """Runs `calls`, a list of (service, data) pairs, concurrently.
+
+        Results are collected in completion order. Each service keeps its own
+        `timeout` counted from the moment the fan-out started, and collecting
+        stops as soon as no pending service has a higher priority than the
+        best ok result; services that were abandoned or timed out get None.
+        Returned results carry the `priority` of their service.
+
+        `alternative(service)` returns another replica of the service, which
+        gets a duplicate request when the service is slower than the recent
+        percentile of its name.
+
+        Every `data` gets the absolute `deadline` of its service as a
+        time.time() value, so backends can drop work nobody waits for;
+        this assumes the hosts' clocks are synchronized.
+        """
+        started = time.time()
+        slots = []
+        owners = {}
+        for service, data in calls:
+            slot = _Slot(service, data, started)
+            data['deadline'] = slot.deadline
+            if alternative and service['name'] in self.__hedged_services:
+                threshold = self.__latencies.percentile(service['name'], self.__hedge_percentile)
+                if threshold is not None and threshold < service['timeout']:
+                    slot.hedge_at = started + threshold
+            future = self.submit(service, data, slot.deadline)
+            slot.futures.append(future)
+            owners[future] = slot
+            slots.append(slot)
+
+        best = -1
+        while True:
+            now = time.time()
+            for slot in slots:
+                if not slot.done and now >= slot.deadline:
+                    slot.done = True
+                if not slot.done and slot.hedge_at is not None and now >= slot.hedge_at:
+                    slot.hedge_at = None
+                    self.__hedge(slot, alternative, owners, now)
+
+            waiting = [s for s in slots if not s.done and s.service['priority'] > best]
+            if not waiting:
+                break
+
+            events = [s.deadline for s in waiting] + [s.hedge_at for s in waiting if s.hedge_at is not None]
+            pending = [f for s in waiting for f in s.futures if f in owners]
+            finished, _ = wait(pending, timeout=max(min(events) - now, 0), return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                slot = owners.pop(future)
+                if slot.done:
+                    continue
+                result = future.result()
+                if result.get('ok') or slot.result is None:
+                    slot.result = result
+                if result.get('ok') or all(f not in owners for f in slot.futures):
+                    slot.done = True
+                if slot.done and slot.result.get('ok'):
+                    best = max(best, slot.service['priority'])
+
+        now = time.time()
+        results = []
+        for slot in slots:
+            for future in slot.futures:
+                future.cancel()
+            result = slot.result if slot.done else None
+            if result is None:
+                reason = 'timeout' if now >= slot.deadline else 'priority'
+                BACKEND_ABANDONED.inc(service=slot.service['name'], reason=reason)
+            if result is not None:
+                result['priority'] = slot.service['priority']
+            results.append(result)
+
+        return results
+
+    def __hedge(self, slot, alternative, owners, now):
+        replica = alternative(slot.service)
+        if not replica:
+            return
+        self.__logger.debug('Hedging %s with %s', slot.service['url'], replica['url'])
+        BACKEND_HEDGES.inc(service=slot.service['name'])
+        future = self.submit(replica, slot.data, slot.deadline)
+        slot.futures.append(future)
+        owners[future] = slot
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        with self.__lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions = {}
@@ -0,0 +1,30 @@
+import bisect
+import hashlib
+
+
+def stable_hash(key):
+    # python's hash() of a str differs between processes
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys (uids) onto nodes (aggregator urls).
+
+    Every node gets `vnodes` points on the ring, so adding or removing a
+    node moves only about 1/len(nodes) of the keys.
+    """
+
+    def __init__(self, nodes=(), vnodes=100):
+        self.nodes = sorted(set(nodes))
+        points = sorted((stable_hash('{}#{}'.format(node, i)), node) for node in self.nodes for i in range(vnodes))
+        self.__hashes = [h for h, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.__nodes:
+            return None
+        i = bisect.bisect(self.__hashes, stable_hash(key)) % len(self.__hashes)
+        return self.__nodes[i]
+
+    def __len__(self):
+        return len(self.nodes)
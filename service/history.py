@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+# rough per-user cost of the dict slot, the tuple and the uid string
+ENTRY_OVERHEAD = 200
+
+
+class _Stripe:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+
+class ChatHistory:
+    """Last `max_length` messages of every user, bounded in users and bytes.
+
+    Users are spread over `stripes`, each with its own lock and its own LRU
+    order; a user's history is one tuple (last_access, message, ...).
+    Users idle for `ttl` seconds and least recently active users beyond
+    `max_users` or `max_bytes` are evicted.
+    """
+
+    def __init__(self, max_length=10, max_users=1000000, max_bytes=512 * 1024 * 1024, ttl=24 * 60 * 60, stripes=64,
+                 logger=None):
+        self.__max_length = max_length
+        self.__stripes = [_Stripe() for _ in range(stripes)]
+        self.__max_users = max(max_users // stripes, 1)
+        self.__max_bytes = max(max_bytes // stripes, 1)
+        self.__ttl = ttl
+        self.__logger = logger or logging.getLogger('ChatHistory')
+
+    def __stripe(self, uid):
+        return self.__stripes[hash(uid) % len(self.__stripes)]
+
+    @staticmethod
+    def __size(entry):
+        return ENTRY_OVERHEAD + sum(len(text) for text in entry[1:])
+
+    def get_history(self, uid, max_length):
+        if not max_length:
+            return
+
+        stripe = self.__stripe(uid)
+        with stripe.lock:
+            entry = stripe.entries.get(uid)
+        if entry is None or time.time() - entry[0] > self.__ttl:
+            return []
+        return list(entry[max(len(entry) - max_length, 1):])
+
+    def add_history(self, uid, *texts):
+        now = time.time()
+        stripe = self.__stripe(uid)
+        with stripe.lock:
+            entry = stripe.entries.pop(uid, None)
+            if entry is None:
+                messages = texts
+            else:
+                stripe.size -= self.__size(entry)
+                messages = entry[1:] + texts
+            entry = (now,) + messages[-self.__max_length:]
+            stripe.entries[uid] = entry
+            stripe.size += self.__size(entry)
+            self.__evict(stripe, now)
+
+    def __evict(self, stripe, now):
+        entries = stripe.entries
+        while entries:
+            uid, entry = next(iter(entries.items()))
+            over = len(entries) > self.__max_users or stripe.size > self.__max_bytes
+            if not over and now - entry[0] <= self.__ttl:
+                break
+            del entries[uid]
+            stripe.size -= self.__size(entry)
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self.__stripes)
+
+    def items(self):
+        """Yields (uid, last_access, messages) for every user, one stripe at a time."""
+        for stripe in self.__stripes:
+            with stripe.lock:
+                entries = list(stripe.entries.items())
+            for uid, entry in entries:
+                yield uid, entry[0], list(entry[1:])
+
+    def pop(self, uid):
+        """Removes a user and returns (last_access, messages), or None."""
+        stripe = self.__stripe(uid)
+        with stripe.lock:
+            entry = stripe.entries.pop(uid, None)
+            if entry is None:
+                return None
+            stripe.size -= self.__size(entry)
+        return entry[0], list(entry[1:])
+
+    def restore(self, uid, last_access, messages):
+        """Puts back a history saved elsewhere unless the user already has a newer one."""
+        stripe = self.__stripe(uid)
+        with stripe.lock:
+            current = stripe.entries.get(uid)
+            if current is not None and current[0] >= last_access:
+                return
+            if current is not None:
+                stripe.size -= self.__size(current)
+            entry = (last_access,) + tuple(messages[-self.__max_length:])
+            stripe.entries[uid] = entry
+            stripe.size += self.__size(entry)
+            self.__evict(stripe, time.time())
+
+    def snapshot(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for uid, last_access, messages in self.items():
+                f.write(json.dumps({'uid': uid, 't': last_access, 'h': messages}, ensure_ascii=False))
+                f.write('\n')
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path):
+        if not os.path.exists(path):
+            return
+        now = time.time()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if now - record['t'] <= self.__ttl:
+                    self.restore(record['uid'], record['t'], record['h'])
+        self.__logger.info('Loaded history of %s users from %s', len(self), path)
+
+    def start_snapshots(self, path, period):
+        def loop():
+            while True:
+                time.sleep(period)
+                try:
+                    self.snapshot(path)
+                except Exception as e:
+                    self.__logger.exception('Exception while saving history snapshot: %s', repr(e))
+
+        thread = threading.Thread(target=loop, name='history_snapshots')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,53 @@
+import logging
+
+import numpy as np
+import torch
+from transformers.pytorch_utils import Conv1D
+
+
+BACKENDS = ('fp32', 'int8')
+
+logger = logging.getLogger('inference')
+
+
+def seed(value):
+    """Seeds numpy and torch; pre-forked workers need a seed each, or they all sample the same candidates."""
+    np.random.seed(value)
+    torch.manual_seed(value)
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """Sets torch thread pools; has to run before the first forward pass."""
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            logger.warning('Could not set inter-op threads: %s', repr(e))
+
+
+def conv1d_to_linear(model):
+    """GPT-2 keeps its projections in transformers' Conv1D, which
+    `quantize_dynamic` does not know about; swap them for nn.Linear."""
+    for name, module in list(model.named_children()):
+        if isinstance(module, Conv1D):
+            nx, nf = module.weight.shape
+            linear = torch.nn.Linear(nx, nf)
+            linear.weight.data = module.weight.data.t().contiguous()
+            linear.bias.data = module.bias.data
+            setattr(model, name, linear)
+        else:
+            conv1d_to_linear(module)
+    return model
+
+
+def prepare_model(model, inference_conf):
+    backend = inference_conf.get('backend', 'fp32')
+    if backend not in BACKENDS:
+        raise ValueError('Unknown inference backend {}, expected one of {}'.format(backend, BACKENDS))
+
+    model.eval()
+    if backend == 'int8':
+        model = torch.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+    return model
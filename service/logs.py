@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from threading import Lock
+
+from flask import g, has_request_context, request
+
+from metrics import Counter
+
+
+DROPPED = Counter('log_records_dropped_total', 'Log records lost to rate limiting or a full queue', ['reason'])
+
+# record attributes, usually passed with extra=, that become fields of the json records
+FIELDS = ('uid', 'service', 'route', 'latency', 'status', 'suppressed')
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(name)s: %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line: time, level, logger, message, the FIELDS a record has and the traceback."""
+
+    def __init__(self, app_name=None):
+        super().__init__()
+        self.__app_name = app_name
+
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3), 'level': record.levelname,
+            'logger': record.name, 'message': record.getMessage(),
+        }
+        if self.__app_name:
+            data['app'] = self.__app_name
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = round(value, 4) if field == 'latency' else value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=repr)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `rates[route]` share of the records below WARNING, `default` for other routes.
+
+    Inside a Flask request the route is the request path and the decision is
+    made once per request, so a sampled request keeps all of its records.
+    """
+
+    def __init__(self, rates=None, default=1.0):
+        super().__init__()
+        self.__rates = rates or {}
+        self.__default = default
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        route = getattr(record, 'route', None)
+        if has_request_context():
+            if route is None:
+                route = record.route = request.path
+            sampled = g.get('_log_sampled')
+            if sampled is None:
+                sampled = g._log_sampled = random.random() < self.__rates.get(route, self.__default)
+        else:
+            sampled = random.random() < self.__rates.get(route, self.__default)
+        return sampled
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket of `rate` records per second for every message template.
+
+    The next record let through after some were dropped carries their
+    number in `suppressed`.
+    """
+
+    MAX_KEYS = 10000
+
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.__rate = rate
+        self.__burst = burst or rate
+        self.__buckets = {}
+        self.__lock = Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.time()
+        with self.__lock:
+            if key not in self.__buckets and len(self.__buckets) >= self.MAX_KEYS:
+                # messages formatted before logging make a key each
+                self.__buckets.clear()
+            tokens, last, suppressed = self.__buckets.get(key, (self.__burst, now, 0))
+            tokens = min(self.__burst, tokens + (now - last) * self.__rate)
+            if tokens < 1:
+                self.__buckets[key] = (tokens, now, suppressed + 1)
+                DROPPED.inc(reason='rate_limited')
+                return False
+            self.__buckets[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Puts records on a bounded queue for the writer thread and never blocks.
+
+    Unlike QueueHandler the record is queued as is, so the message is
+    formatted in the writer thread; log values, not request proxies or
+    objects that change later. Records that find the queue full are dropped.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(reason='queue_full')
+
+
+class AsyncLogging:
+    """The handler of the root logger and the thread writing what it queues to stderr."""
+
+    def __init__(self, conf=None, app_name=None):
+        conf = conf or {}
+        self.__queue_size = conf.get('queue_size', 10000)
+        self.__writer = logging.StreamHandler(sys.stderr)
+        if conf.get('format', 'json') == 'json':
+            self.__writer.setFormatter(JsonFormatter(app_name))
+        else:
+            self.__writer.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        self.handler = AsyncHandler(queue.Queue(self.__queue_size))
+        self.handler.addFilter(SamplingFilter(conf.get('sample'), conf.get('default_sample', 1.0)))
+        if conf.get('rate_limit'):
+            self.handler.addFilter(RateLimitFilter(conf['rate_limit']))
+        self.__listener = None
+
+    def start(self):
+        self.__listener = logging.handlers.QueueListener(self.handler.queue, self.__writer)
+        self.__listener.start()
+
+    def stop(self):
+        if self.__listener is not None:
+            self.__listener.stop()
+            self.__listener = None
+
+    def after_fork(self):
+        # the writer thread is not copied into a forked child, and the queue may be locked by it
+        self.handler.queue = queue.Queue(self.__queue_size)
+        self.start()
+
+
+ASYNC_LOGGING = None
+
+
+def setup_logging(conf=None, app_name=None, loggers=()):
+    """Sends all logging through one AsyncLogging, configured by the "logging" section of a service config:
+
+    level (INFO), format (json or text), queue_size, sample ({route: share}),
+    default_sample (1.0), rate_limit (records per second per message, off by
+    default) and access_log (false, werkzeug's line per request).
+    `loggers` lose their own handlers, like Flask's default one, and their
+    own level, so they go through the root logger like the rest.
+    """
+    global ASYNC_LOGGING
+    conf = conf or {}
+    level = getattr(logging, conf.get('level', 'INFO').upper())
+    if ASYNC_LOGGING is not None:
+        ASYNC_LOGGING.stop()
+    ASYNC_LOGGING = AsyncLogging(conf, app_name)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(ASYNC_LOGGING.handler)
+    root.setLevel(level)
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+    if not conf.get('access_log', False):
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    ASYNC_LOGGING.start()
+    return ASYNC_LOGGING
+
+
+def add_logging_arguments(parser):
+    """--log-level and --log-format for the services configured from the command line only."""
+    parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--log-format', default='json', help='json or text')
+
+
+def logging_conf_from_args(args):
+    return {'level': args.log_level, 'format': args.log_format}
+
+
+def _stop():
+    if ASYNC_LOGGING is not None:
+        ASYNC_LOGGING.stop()
+
+
+def _after_fork():
+    if ASYNC_LOGGING is not None:
+        ASYNC_LOGGING.after_fork()
+
+
+atexit.register(_stop)
+os.register_at_fork(after_in_child=_after_fork)
@@ -1,78 +1,84 @@
-import copy
-import time
+import os
 import sys
+import time
 import threading
 
 import flask
 import json
-import random
-import requests
 import argparse
-from collections import defaultdict, deque
+import requests
+from collections import defaultdict
 from flask import request, Response
-from threading import Thread, Lock
+from threading import Lock
 
 from client import ServiceRegistryClient
+from fanout import FanOut
+from balancer import Balancer
+from admission import AdaptiveLimit, UidLimits
+from history import ChatHistory
+from hash_ring import HashRing
+from cache import ResponseCache
+from retrieval import RetrievalIndex
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from wire import SharedBody, Body, read_request, response
+from logs import setup_logging
 
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = True
+REGISTRY.register_endpoint(app)
 
-
-class ThreadWithReturnValue(Thread):
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}):
-        Thread.__init__(self, group, target, name, args, kwargs)
-        self._return = None
-
-    def run(self):
-        try:
-            if self._target:
-                self._return = self._target(*self._args, **self._kwargs)
-        finally:
-            del self._target, self._args, self._kwargs
-
-    def get_return(self):
-        return self._return
+REQUESTS = Counter('aggregator_requests_total', 'Answered requests by the service that answered', ['source'])
+REQUEST_LATENCY = Histogram('aggregator_request_seconds', 'Latency of answered requests')
+REJECTED = Counter('aggregator_rejected_total', 'Requests rejected by admission control', ['reason'])
+FALLBACKS = Counter('aggregator_fallbacks_total', 'Fallback replies by how they were found', ['kind'])
 
 
 class UserQuoatas:
-    def __init__(self):
-        self.__max_in_flight = 0
-        self.__max_in_flight_for_uid = 0
-
-        self.__in_flight_for_uid = {}
-        self.__in_flight = 0
+    """Admission control: per-uid in-flight limit and token bucket, plus a
+    global concurrency limit, fixed at max_in_flight or, with an "adaptive"
+    section of AdaptiveLimit arguments, adapting to the latency of backend calls."""
 
-        self.__lock = Lock()
+    def __init__(self, shards=64):
+        self.__uids = UidLimits(shards)
+        self.__global = AdaptiveLimit()
 
     def on_request(self, uid):
-        with self.__lock:
-            if self.__in_flight > self.__max_in_flight + 1:
-                return False
-            q = self.__in_flight_for_uid.get(uid, 0)
-            if q > self.__max_in_flight + 1:
-                return False
-            self.__in_flight_for_uid[uid] = q + 1
+        if not self.__uids.acquire(uid):
+            REJECTED.inc(reason='uid')
+            return False
+        if not self.__global.acquire():
+            self.__uids.release(uid)
+            REJECTED.inc(reason='global')
+            return False
         return True
 
     def on_request_finished(self, uid):
-        with self.__lock:
-            q = self.__in_flight_for_uid.get(uid, 0)
-            if q == 0:
-                raise Exception('called on_request_finished on unknown uid {}'.format(uid))
-            self.__in_flight_for_uid[uid] = q - 1
+        self.__global.release()
+        self.__uids.release(uid)
+
+    def on_backend_finished(self, url, latency, name=None):
+        self.__global.observe(url, latency, name)
 
     def update(self, quota_conf):
-        with self.__lock:
-            self.__max_in_flight = quota_conf['max_in_flight']
-            self.__max_in_flight_for_uid = quota_conf['max_in_flight_for_uid']
+        self.__uids.update(
+            quota_conf['max_in_flight_for_uid'], quota_conf.get('rate_per_uid'), quota_conf.get('burst_per_uid'))
+        max_in_flight = quota_conf['max_in_flight']
+        if 'adaptive' in quota_conf:
+            self.__global.configure(max_limit=max_in_flight, **quota_conf['adaptive'])
+        else:
+            self.__global.configure(max_in_flight, max_in_flight, max_in_flight)
 
+    def stats(self):
+        return {'limit': self.__global.limit, 'in_flight': self.__global.in_flight}
 
 
 class Services:
-    def __init__(self):
+    def __init__(self, **balancing_conf):
         self.__lock = Lock()
-        self.__services_list = []
+        self.__services_list = {}
+        self.__names = {}
+        self.__balancer = Balancer(**balancing_conf)
 
     def get_services(self):
         with self.__lock:
@@ -80,9 +86,22 @@ class Services:
 
         services = []
         for service_list in services_list.values():
-            services.append(random.choice(service_list))
+            services.append(self.__balancer.choose(service_list))
         return services
 
+    def get_alternative(self, service):
+        with self.__lock:
+            services_list = self.__services_list
+
+        return self.__balancer.choose(services_list.get(service['name'], []), exclude=service['url'])
+
+    def on_start(self, url):
+        self.__balancer.on_start(url)
+
+    def on_finish(self, url, latency, ok):
+        self.__balancer.on_finish(url, latency, ok)
+        USER_QUOTAS.on_backend_finished(url, latency, self.__names.get(url))
+
     def update(self, services_conf):
         services_conf = sorted(services_conf, key=lambda s: s['url'])
         services_list = defaultdict(list)
@@ -90,73 +109,122 @@ class Services:
             services_list[s['name']] += [s]
         with self.__lock:
             self.__services_list = services_list
-
-
-class ChatHistory:
-    def __init__(self, max_length=10):
-        self.__history = defaultdict(lambda : deque(maxlen=max_length))
-        self.__lock = threading.Lock()
-
-    def get_history(self, uid, max_length):
-        if not max_length:
-            return
-
-        with self.__lock:
-            history = list(self.__history[uid])
-        if max_length > len(history):
-            return history
-        return history[-max_length:]
-
-    def add_history(self, uid, text):
-        with self.__lock:
-            self.__history[uid].append(text)
+            self.__names = {s['url']: s['name'] for s in services_conf}
+        self.__balancer.retain(s['url'] for s in services_conf)
 
 
 USER_QUOTAS = UserQuoatas()
 SERVICES = Services()
-CHAT_HISTORY = ChatHistory()
-
+CHAT_HISTORY = ChatHistory(logger=app.logger)
+FANOUT = FanOut(observer=SERVICES, logger=app.logger)
+RESPONSE_CACHE = ResponseCache()
+FALLBACK_INDEX = None
+FALLBACK_REPLY_CONF = {}
+
+Gauge('aggregator_in_flight', 'Requests being answered', callback=lambda: USER_QUOTAS.stats()['in_flight'])
+Gauge('aggregator_concurrency_limit', 'Current global concurrency limit', callback=lambda: USER_QUOTAS.stats()['limit'])
+Gauge('aggregator_history_users', 'Users with chat history', callback=lambda: len(CHAT_HISTORY))
+Gauge('aggregator_response_cache_hit_ratio', 'Hit ratio of the response cache',
+      callback=lambda: RESPONSE_CACHE.stats()['hit_ratio'])
+Gauge('aggregator_response_cache_entries', 'Queries in the response cache',
+      callback=lambda: RESPONSE_CACHE.stats()['entries'])
+HANDOFF_BATCH_SIZE = 1000
+
+
+class HistoryHandoff:
+    """Sends the history of uids this aggregator no longer owns to their new owner.
+
+    The Telegram bot routes every uid to the aggregator that owns it on a
+    consistent-hash ring of the registered aggregators; when the ring
+    changes, so does the owner of some uids.
+    """
+
+    def __init__(self, own_url, session=None):
+        self.__own_url = own_url
+        self.__ring = HashRing([own_url])
+        self.__lock = Lock()
+        self.__session = session or requests.Session()
 
-def fetch(url, data, timeout):
-    started = time.time()
-    try:
-        app.logger.debug('Starting {} with data {}'.format(url, data))
-        r = requests.post(url, json=data, timeout=timeout)
-        finished = time.time()
-        app.logger.debug('Got for {} with data {} result {}, elapsed {}'.format(url, data, r.content, finished - started))
-        return r.json()
-    except Exception as e:
-        finished = time.time()
-        app.logger.exception('Got for {} with data {} exception {}, elapsed {}'.format(url, data, repr(e), finished - started))
-        return {'ok': False, 'error': repr(e)}
+    def on_aggregators_update(self, aggregators_conf):
+        ring = HashRing([s['url'] for s in aggregators_conf] + [self.__own_url])
+        with self.__lock:
+            if ring.nodes == self.__ring.nodes:
+                return
+            self.__ring = ring
+        thread = threading.Thread(target=self.try_handoff, args=(ring,), name='history_handoff')
+        thread.daemon = True
+        thread.start()
+
+    def try_handoff(self, ring):
+        try:
+            self.handoff(ring)
+        except Exception as e:
+            app.logger.exception('Exception during history handoff: %s', repr(e))
+
+    def handoff(self, ring):
+        moving = defaultdict(list)
+        for uid, _, _ in CHAT_HISTORY.items():
+            owner = ring.owner(uid)
+            if owner != self.__own_url:
+                moving[owner].append(uid)
+
+        for owner, uids in moving.items():
+            for i in range(0, len(uids), HANDOFF_BATCH_SIZE):
+                records = []
+                for uid in uids[i:i + HANDOFF_BATCH_SIZE]:
+                    entry = CHAT_HISTORY.pop(uid)
+                    if entry is not None:
+                        records.append({'uid': uid, 't': entry[0], 'h': entry[1]})
+                try:
+                    self.__session.post(history_import_url(owner), json=records, timeout=10).raise_for_status()
+                except Exception:
+                    for record in records:
+                        CHAT_HISTORY.restore(record['uid'], record['t'], record['h'])
+                    raise
+            app.logger.info('Handed off history of %s uids to %s', len(uids), owner)
+
+
+def history_import_url(aggregator_url):
+    return aggregator_url.rsplit('/', 1)[0] + '/history/import'
 
 
 def fetch_all(data, uid):
-    threads = []
     services = SERVICES.get_services()
-    for service in services:
-        url = service['url']
-        timeout = service['timeout']
-        history_len = service['history_len']
-        thread_name = "{}_for_{}".format(service['name'], uid)
-        data = copy.deepcopy(data)
-        data['history'] = []
-        if history_len:
-            data['history'] = CHAT_HISTORY.get_history(uid, history_len)
-        kw = {'url': url, 'data': data, 'timeout': timeout}
-        threads.append(ThreadWithReturnValue(target=fetch, name=thread_name, kwargs=kw))
-
-    for t in threads:
-        t.start()
-
-    results = []
-    for i, t in enumerate(threads):
-        t.join(timeout=services[i]['timeout'])
-        result = t.get_return()
-        if result is not None:
-            result['priority'] = services[i]['priority']
-        results.append(result)
 
+    # answers of history independent services may come from the cache, and then
+    # services that could not beat the best cached answer are not called at all
+    cached = {}
+    best = -1
+    for i in sorted(range(len(services)), key=lambda i: -services[i]['priority']):
+        service = services[i]
+        if service['priority'] <= best or not ResponseCache.cacheable(service):
+            continue
+        result = RESPONSE_CACHE.get(service['name'], data['query'])
+        if result is not None:
+            result['uid'] = uid
+            result['priority'] = best = service['priority']
+            cached[i] = result
+    called = [i for i, s in enumerate(services) if i not in cached and s['priority'] > best]
+
+    history_len = max((services[i]['history_len'] for i in called), default=0)
+    history = CHAT_HISTORY.get_history(uid, history_len)
+
+    # the fields every service gets are encoded once, only the history slice differs
+    shared = SharedBody(data)
+    calls = []
+    for i in called:
+        service = services[i]
+        history_len = service['history_len']
+        calls.append((service, Body(shared, history=history[-history_len:] if history_len else [])))
+
+    results = [cached.get(i) for i in range(len(services))]
+    for i, result in zip(called, FANOUT.fetch_all(calls, SERVICES.get_alternative)):
+        results[i] = result
+        service = services[i]
+        if result and result['ok'] and ResponseCache.cacheable(service):
+            result = dict(result)
+            result.pop('priority', None)
+            RESPONSE_CACHE.put(service['name'], data['query'], result)
     return results
 
 
@@ -167,12 +235,19 @@ def postprocess(results):
             continue
         if result and not x['ok']:
             continue
-        if x['priority'] > result.get('priority', -1):
+        if not result.get('ok') or x['priority'] > result['priority']:
             result = x
 
     return result or {'ok': False, 'error': 'All services are unavailable'}
 
 def fallback(uid, query):
+    if FALLBACK_INDEX is not None:
+        ans = FALLBACK_INDEX.reply(query, **FALLBACK_REPLY_CONF)
+        if ans is not None:
+            FALLBACKS.inc(kind='retrieval')
+            return {'from': 'fallback', 'ok': False, 'uid': uid, 'reply': ans}
+
+    FALLBACKS.inc(kind='keyword')
     prepared_answers = {
         'дела':'Нормально!',
         'делаешь':'Даже не знаю...',
@@ -192,27 +267,31 @@ def fallback(uid, query):
 
 @app.route('/api', methods=['POST'])
 def main_api():
-    req = request.json
+    req = read_request()
     app.logger.debug('Got request %s', req)
     uid = req['uid']
-    fallback_result = fallback(req['uid'], req['query'])
     if USER_QUOTAS.on_request(uid):
+        started = time.time()
         try:
             results = fetch_all(req, uid)
             app.logger.debug('Got results, req: %s, results: %s', req, results)
             result = postprocess(results)
             if not result['ok']:
-                result = fallback_result
+                result = fallback(uid, req['query'])
         except Exception as e:
-            app.logger.exception('Exception in main_api for request {}, exception {}'.format(req, repr(e)))
-            result = fallback_result
+            app.logger.exception('Exception in main_api for request %s, exception %s', req, repr(e))
+            result = fallback(uid, req['query'])
 
+        latency = time.time() - started
         USER_QUOTAS.on_request_finished(uid)
-        CHAT_HISTORY.add_history(uid, req['query'])
-        CHAT_HISTORY.add_history(uid, result['reply'])
+        REQUEST_LATENCY.observe(latency)
+        REQUESTS.inc(source=result.get('from', 'unknown'))
+        CHAT_HISTORY.add_history(uid, req['query'], result['reply'])
+        app.logger.info('Answered', extra={'uid': uid, 'service': result.get('from'), 'latency': latency})
     else:
+        app.logger.info('Rejected', extra={'uid': uid, 'status': 429})
         return Response("", status=429)
-    return json.dumps(result, ensure_ascii=False)
+    return response(result)
 
 
 @app.route('/update_services', methods=['POST'])
@@ -222,6 +301,19 @@ def update_services():
     return json.dumps({'updated': True}, ensure_ascii=False)
 
 
+@app.route('/history/import', methods=['POST'])
+def history_import():
+    records = request.json
+    for record in records:
+        CHAT_HISTORY.restore(record['uid'], record['t'], record['h'])
+    return json.dumps({'imported': len(records)}, ensure_ascii=False)
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return json.dumps(RESPONSE_CACHE.stats(), ensure_ascii=False)
+
+
 @app.route('/update_quoatas', methods=['POST'])
 def update_quoatas():
     req = request.json
@@ -251,7 +343,27 @@ def main():
 
     with open(args.config_path) as f:
         config = json.load(f)
-
+    setup_logging(config.get('logging'), config['service_registry']['conf']['name'], [app.logger])
+
+    global FANOUT, SERVICES, CHAT_HISTORY, RESPONSE_CACHE, FALLBACK_INDEX, FALLBACK_REPLY_CONF
+    history_conf = dict(config.get('chat_history', {}))
+    snapshot_path = history_conf.pop('snapshot_path', None)
+    snapshot_period = history_conf.pop('snapshot_period', 300)
+    CHAT_HISTORY = ChatHistory(logger=app.logger, **history_conf)
+    if snapshot_path:
+        CHAT_HISTORY.load_snapshot(snapshot_path)
+        CHAT_HISTORY.start_snapshots(snapshot_path, snapshot_period)
+
+    RESPONSE_CACHE = ResponseCache(**config.get('response_cache', {}))
+    FALLBACK_REPLY_CONF = dict(config.get('fallback_index', {}))
+    index_path = FALLBACK_REPLY_CONF.pop('path', None)
+    if index_path and os.path.exists(index_path):
+        FALLBACK_INDEX = RetrievalIndex(index_path)
+        app.logger.info('Loaded fallback index of %s answers from %s', len(FALLBACK_INDEX), index_path)
+    elif index_path:
+        app.logger.warning('No fallback index at %s, falling back to keywords only', index_path)
+    SERVICES = Services(**config.get('balancing', {}))
+    FANOUT = FanOut(observer=SERVICES, logger=app.logger, **config.get('fanout', {}))
     SERVICES.update(config['service_conf'])
     USER_QUOTAS.update(config['user_quoatas'])
 
@@ -259,6 +371,11 @@ def main():
     registry = ServiceRegistryClient(registry_conf['conf'], registry_conf['url'], registry_conf['services_names'], SERVICES.update)
     registry.start()
 
+    handoff = HistoryHandoff(registry_conf['conf']['url'])
+    aggregators = ServiceRegistryClient(
+        None, registry_conf['url'], [registry_conf['conf']['name']], handoff.on_aggregators_update, logger=app.logger)
+    aggregators.start()
+
     app.run(host='0.0.0.0', port=args.port, threaded=True)
 
 
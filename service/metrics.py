@@ -0,0 +1,142 @@
+import bisect
+import threading
+
+from flask import Response
+
+
+# seconds, from a cache hit to a slow generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).add(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """Yields (name suffix, label values, extra labels, value)."""
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield '', key, (), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(self.labels, key, extra), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """A value that is set, or read from `callback` on every scrape.
+
+    A callback of a labeled gauge returns {label values tuple: value}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.__callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.__callback is None:
+            yield from super().samples()
+            return
+        values = self.__callback()
+        if not self.labels:
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield '', key, (), value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.__buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket, then the +Inf count and the sum
+                counts = self._values[key] = [0] * (len(self.__buckets) + 2)
+            counts[bisect.bisect_left(self.__buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.__buckets + (float('inf'),), counts):
+                total += count
+                yield '_bucket', key, (('le', format_value(bound)),), total
+            yield '_count', key, (), total
+            yield '_sum', key, (), counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics = []
+        self.__lock = threading.Lock()
+
+    def add(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+    def register_endpoint(self, app):
+        def metrics():
+            return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+        app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+
+
+REGISTRY = Registry()
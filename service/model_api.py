@@ -1,23 +1,57 @@
 import sys
+import time
 import flask
 import json
 from flask import request
-import numpy as np
 import torch
 import argparse
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import GPT2LMHeadModel, GPT2Tokenizer, StoppingCriteria, StoppingCriteriaList
 from dostoevsky.tokenization import RegexTokenizer
 from dostoevsky.models import FastTextSocialNetworkModel
 
 from client import ServiceRegistryClient
+from batching import MicroBatcher, DeadlineExceeded
+from inference import configure_threads, prepare_model, seed
+from readiness import Readiness, load_parallel
+from cache import PrefixCache
+from prefork import PreforkServer
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from logs import setup_logging
+from wire import read_request, response
 
 
 TOK = None
 MODEL = None
 CONFIG = None
+BATCHER = None
+STOP_TOKEN_IDS = None
+RESULT_VALIDATION = None
+PREFIX_CACHE = None
+
+# '<' starts the eos token, a newline starts the next turn of the dialogue
+REPLY_DELIMITERS = ('<', '\n')
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = True
+READINESS = Readiness(logger=app.logger)
+READINESS.register_endpoint(app)
+REGISTRY.register_endpoint(app)
+
+ANSWER_LATENCY = Histogram('model_answer_seconds', 'Time to answer a request, queueing included')
+GENERATION_LATENCY = Histogram('model_generation_seconds', 'Time of one generate call for a batch')
+TOKENS = Counter('model_tokens_total', 'Prompt and generated tokens', ['kind'])
+VALIDATION = Counter('model_validation_total', 'Candidates that passed or failed validation', ['result'])
+ANSWERS = Counter('model_answers_total', 'Answers by whether any candidate passed validation', ['ok'])
+ABANDONED = Counter('model_abandoned_total', 'Requests given up after their deadline, by stage', ['stage'])
+# under pre-fork the cold start of a worker counts from its fork and leaves out the master's load
+Gauge('model_cold_start_seconds', 'Seconds from process start, or from the fork of a worker, to ready',
+      callback=READINESS.cold_start_seconds)
+LOAD_SECONDS = Gauge('model_load_seconds', 'Seconds the weights, tokenizer and validation took to load')
+Gauge('model_queue_size', 'Requests waiting for a batch', callback=lambda: BATCHER.queue_size if BATCHER else 0)
+Gauge('model_prefix_cache_hit_ratio', 'Hit ratio of the per-uid prompt state cache',
+      callback=lambda: PREFIX_CACHE.stats()['hit_ratio'] if PREFIX_CACHE is not None else 0)
+Gauge('model_prefix_cache_bytes', 'Memory taken by the cached prompt states',
+      callback=lambda: PREFIX_CACHE.stats()['memory_bytes'] if PREFIX_CACHE is not None else 0)
 
 class ResultValidation:
     def __init__(self):
@@ -26,46 +60,240 @@ class ResultValidation:
         pass
 
     def validate(self, text):
+        return self.validate_batch([text])[0]
+
+    def validate_batch(self, texts):
         try:
-            return self.__model.predict([text], k=2)[0].get('negative', 0) < 0.3
+            passed = [p.get('negative', 0) < 0.3 for p in self.__model.predict(texts, k=2)]
         except Exception as e:
             app.logger.exception('Exception during result validation: %s', repr(e))
-            return True
-
+            VALIDATION.inc(len(texts), result='error')
+            return [True for _ in texts]
+        VALIDATION.inc(passed.count(True), result='passed')
+        VALIDATION.inc(passed.count(False), result='rejected')
+        return passed
 
-RESULT_VALIDATION = ResultValidation()
 
 
-def get_answer(query, history):
+def build_prompt(query, history):
     parts = history + [query]
-    q = '- {}\n-'.format('\n- '.join(parts))
-    input = TOK.encode(q, return_tensors="pt")
-    out = MODEL.generate(
-        input, max_length=CONFIG['max_length'], repetition_penalty=5.0,
-        do_sample=True, top_k=CONFIG['top_k'], top_p=0.95, temperature=1)
+    return '- {}\n-'.format('\n- '.join(parts))
+
+
+def cut_reply(text):
+    for delimiter in REPLY_DELIMITERS:
+        text = text.split(delimiter)[0]
+    return text.strip().replace('  ', ' ')
+
+
+class ReplyStoppingCriteria(StoppingCriteria):
+    """Stops generation once every row produced a delimiter, spent its budget
+    or passed its deadline."""
+
+    def __init__(self, prompt_length, budgets, deadlines):
+        self.__prompt_length = prompt_length
+        self.__budgets = budgets
+        self.__deadlines = deadlines
+        self.__finished = [not budget for budget in budgets]
+        self.expired = [False for _ in budgets]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.__prompt_length
+        last_tokens = input_ids[:, -1].tolist()
+        now = time.time()
+        for i, token in enumerate(last_tokens):
+            if self.__finished[i]:
+                continue
+            if token in STOP_TOKEN_IDS or generated >= self.__budgets[i]:
+                self.__finished[i] = True
+            elif self.__deadlines[i] is not None and now >= self.__deadlines[i]:
+                self.__finished[i] = self.expired[i] = True
+        return all(self.__finished)
+
+
+def state_size(past):
+    return sum(t.element_size() * t.nelement() for layer in past for t in layer)
+
+
+def prefill(rows, uids):
+    """Past key/values of every row of token ids, all but its last token.
+
+    A row whose uid has a cached state for its beginning runs the model only
+    over the tokens after it; the other rows run in one left-padded batch.
+    Every new state is cached for the next prompt of its uid.
+    """
+    pasts = [None for _ in rows]
+    misses = []
+    for i, (row, uid) in enumerate(zip(rows, uids)):
+        cached_length, past = PREFIX_CACHE.get(uid, row[:-1]) if PREFIX_CACHE is not None and uid is not None else (0, None)
+        if past is None:
+            misses.append(i)
+            continue
+        if cached_length < len(row) - 1:
+            position_ids = torch.arange(cached_length, len(row) - 1).unsqueeze(0)
+            past = MODEL(torch.tensor([row[cached_length:-1]]), past_key_values=past,
+                         position_ids=position_ids, use_cache=True).past_key_values
+        TOKENS.inc(cached_length, kind='cached')
+        pasts[i] = past
+
+    if misses:
+        length = max(len(rows[i]) - 1 for i in misses)
+        input_ids = torch.full((len(misses), length), TOK.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(misses), length), dtype=torch.long)
+        for j, i in enumerate(misses):
+            n = len(rows[i]) - 1
+            input_ids[j, length - n:] = torch.tensor(rows[i][:-1])
+            attention_mask[j, length - n:] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        past = MODEL(input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True).past_key_values
+        for j, i in enumerate(misses):
+            n = len(rows[i]) - 1
+            pasts[i] = tuple((k[j:j + 1, :, length - n:].clone(), v[j:j + 1, :, length - n:].clone()) for k, v in past)
+
+    if PREFIX_CACHE is not None:
+        for row, uid, past in zip(rows, uids, pasts):
+            if uid is not None:
+                PREFIX_CACHE.put(uid, row[:-1], past, state_size(past))
+    return pasts
+
+
+def stack_pasts(pasts, length):
+    """One left-padded batch of `length` positions out of the pasts of single rows."""
+    stacked = []
+    for layer in zip(*pasts):
+        key, value = layer[0][0], layer[0][1]
+        keys = key.new_zeros((len(pasts), key.shape[1], length, key.shape[3]))
+        values = value.new_zeros((len(pasts), value.shape[1], length, value.shape[3]))
+        for j, (k, v) in enumerate(layer):
+            keys[j, :, length - k.shape[2]:] = k[0]
+            values[j, :, length - v.shape[2]:] = v[0]
+        stacked.append((keys, values))
+    return tuple(stacked)
+
+
+def generate_answers(items):
+    """`items` are (prompt, max_new_tokens, deadline, uid) tuples, all but the prompt may be None.
+
+    Returns `num_candidates` sampled answers for every item; answers of
+    items that passed their deadline are cut where it passed. Prompts are
+    run through the model once, whatever the number of candidates, and
+    reuse the cached state of the previous prompt of their uid.
+    """
+    num_candidates = CONFIG.get('num_candidates', 1)
+    rows = TOK([prompt for prompt, _, _, _ in items])['input_ids']
+    lengths = [len(row) for row in rows]
+
+    budgets = []
+    for length, (_, max_new_tokens, _, _) in zip(lengths, items):
+        budget = max(CONFIG['max_length'] - length, 0)
+        if max_new_tokens is not None:
+            budget = min(budget, max(max_new_tokens, 0))
+        budgets.append(budget)
+    if not max(budgets):
+        return [['' for _ in range(num_candidates)] for _ in items]
+    budgets = [budget for budget in budgets for _ in range(num_candidates)]
+    deadlines = [deadline for _, _, deadline, _ in items for _ in range(num_candidates)]
+
+    started = time.time()
+    with torch.inference_mode():
+        pasts = prefill(rows, [uid for _, _, _, uid in items])
+        prompt_length = max(lengths)
+        input_ids = torch.full((len(rows), prompt_length), TOK.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), prompt_length), dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i, prompt_length - len(row):] = torch.tensor(row)
+            attention_mask[i, prompt_length - len(row):] = 1
+        past = tuple((k.repeat_interleave(num_candidates, 0), v.repeat_interleave(num_candidates, 0))
+                     for k, v in stack_pasts(pasts, prompt_length - 1))
+
+        stopping_criteria = ReplyStoppingCriteria(prompt_length, budgets, deadlines)
+        out = MODEL.generate(
+            input_ids.repeat_interleave(num_candidates, 0), attention_mask=attention_mask.repeat_interleave(num_candidates, 0),
+            past_key_values=past, max_new_tokens=max(budgets),
+            stopping_criteria=StoppingCriteriaList([stopping_criteria]),
+            pad_token_id=TOK.pad_token_id, repetition_penalty=5.0,
+            do_sample=CONFIG.get('do_sample', True), top_k=CONFIG['top_k'], top_p=0.95, temperature=1)
+    GENERATION_LATENCY.observe(time.time() - started)
+    ABANDONED.inc(sum(stopping_criteria.expired[::num_candidates]), stage='generation')
+    TOKENS.inc(sum(lengths), kind='prompt')
+
+    answers = []
+    for row, budget in zip(out[:, prompt_length:].tolist(), budgets):
+        row = row[:budget]
+        for i, token in enumerate(row):
+            if token in STOP_TOKEN_IDS:
+                row = row[:i + 1]
+                break
+        TOKENS.inc(len(row), kind='generated')
+        answers.append(cut_reply(TOK.decode(row)))
+    return [answers[i:i + num_candidates] for i in range(0, len(answers), num_candidates)]
 
-    raw = TOK.decode(out[0])
-    raw = raw[len(q):]
-    ans = raw.split('<')[0].strip()
-    return ans.replace('  ', ' ')
+
+def answer_batch(items):
+    """Returns (answer, ok) for every item: the first candidate that passed validation, if any."""
+    candidates = generate_answers(items)
+    passed = RESULT_VALIDATION.validate_batch([c for item_candidates in candidates for c in item_candidates])
+
+    results = []
+    for i, item_candidates in enumerate(candidates):
+        item_passed = passed[i * len(item_candidates):(i + 1) * len(item_candidates)]
+        ok = [c for c, p in zip(item_candidates, item_passed) if p]
+        if ok:
+            results.append((ok[0], True))
+        else:
+            results.append((item_candidates[0], False))
+    return results
+
+
+def get_answer(query, history, max_new_tokens=None, deadline=None, uid=None):
+    started = time.time()
+    item = (build_prompt(query, history), max_new_tokens, deadline, uid)
+    answer, ok = BATCHER.submit(item, deadline=deadline).result()
+    ANSWER_LATENCY.observe(time.time() - started)
+    ANSWERS.inc(ok=str(ok).lower())
+    return answer, ok
+
+
+def deadline_exceeded_response(uid):
+    # the caller has already given up, so the answer is short and cheap
+    return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': 'Deadline exceeded'})
 
 
 @app.route('/api', methods=['POST'])
 def home():
-    app.logger.debug('New request: %s', request)
-    req = request.json
+    if not READINESS.is_ready():
+        return READINESS.not_ready_response()
+    req = read_request()
     app.logger.debug('Got request: %s', req)
     uid = req['uid']
 
-    res = get_answer(req['query'], req['history'])
-    if not RESULT_VALIDATION.validate(res):
-        return json.dumps(
-            {'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': 'Validation of result did not pass'},
-            ensure_ascii=False)
+    deadline = req.get('deadline')
+    if deadline is not None and deadline <= time.time():
+        ABANDONED.inc(stage='arrival')
+        return deadline_exceeded_response(uid)
+    started = time.time()
+    try:
+        # prompts without history come from services that get none, or from a first turn, and
+        # would only evict the states of conversations that go on
+        cache_uid = uid if req['history'] else None
+        res, ok = get_answer(req['query'], req['history'], req.get('max_new_tokens'), deadline, cache_uid)
+    except DeadlineExceeded:
+        ABANDONED.inc(stage='queue')
+        return deadline_exceeded_response(uid)
+    if deadline is not None and deadline <= time.time():
+        # generation was cut short at the deadline
+        return deadline_exceeded_response(uid)
+    app.logger.info('Answered', extra={'uid': uid, 'latency': time.time() - started, 'status': 'ok' if ok else 'rejected'})
+    if not ok:
+        return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': 'Validation of result did not pass'})
+
+    app.logger.debug('Got answer: %s for request: %s', res, req)
+    return response({'uid': uid, 'from': CONFIG['name'], 'ok': True, 'reply': res})
 
-    reply = json.dumps(res, ensure_ascii=False)
-    app.logger.debug('Got answer: %s for request: %s', reply, req)
-    return json.dumps({'uid': uid, 'from': CONFIG['name'], 'ok': True, 'reply': res}, ensure_ascii=False)
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return json.dumps(PREFIX_CACHE.stats() if PREFIX_CACHE is not None else {}, ensure_ascii=False)
 
 
 def shutdown_server():
@@ -81,26 +309,131 @@ def shutdown():
     return 'Server shutting down...'
 
 
+def find_stop_token_ids(tokenizer):
+    stop_ids = set()
+    for token, token_id in tokenizer.get_vocab().items():
+        text = tokenizer.convert_tokens_to_string([token])
+        if any(delimiter in text for delimiter in REPLY_DELIMITERS):
+            stop_ids.add(token_id)
+    return stop_ids
+
+
+def warmup():
+    prompts = [(build_prompt('Привет! Как дела?', []), None, None, None)] * CONFIG.get('max_batch_size', 1)
+    answer_batch(prompts)
+
+
+def load_tokenizer(model_path):
+    tok = GPT2Tokenizer.from_pretrained(model_path)
+    tok.padding_side = 'left'
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    return tok
+
+
+def load(config, serve=True):
+    global TOK, MODEL, CONFIG, STOP_TOKEN_IDS, RESULT_VALIDATION, PREFIX_CACHE
+    started = time.time()
+    CONFIG = config
+    inference_conf = CONFIG.get('inference', {})
+    configure_threads(inference_conf.get('intra_op_threads'), inference_conf.get('inter_op_threads'))
+
+    # model.safetensors, if present, is memory-mapped instead of read into memory
+    loaded = load_parallel({
+        'tokenizer': lambda: load_tokenizer(CONFIG['model_path']),
+        'model': lambda: GPT2LMHeadModel.from_pretrained(CONFIG['model_path']),
+        'validation': ResultValidation,
+    }, logger=app.logger)
+    TOK = loaded['tokenizer']
+    RESULT_VALIDATION = loaded['validation']
+    STOP_TOKEN_IDS = find_stop_token_ids(TOK)
+    MODEL = prepare_model(loaded['model'], inference_conf)
+    prefix_cache_conf = CONFIG.get('prefix_cache')
+    if prefix_cache_conf:
+        # a prompt extends the previous one of its uid only while the history
+        # window still grows: a turn adds the query and the reply, and once
+        # the window is full its oldest messages drop out of the prompt
+        history_len = CONFIG['service_registry']['conf'].get('history_len', 0)
+        if history_len < 4:
+            app.logger.warning('The prompt state cache never hits with history_len %s', history_len)
+        PREFIX_CACHE = PrefixCache(int(prefix_cache_conf.get('max_mb', 512) * 2 ** 20))
+    # set before the fork, so pre-forked workers report the master's load
+    LOAD_SECONDS.set(time.time() - started)
+    if serve:
+        start_serving()
+
+
+def start_serving():
+    """Warms up and starts the batcher; in pre-fork mode runs in every worker, as threads do not survive fork."""
+    global BATCHER
+    if CONFIG.get('inference', {}).get('warmup', True):
+        warmup()
+
+    BATCHER = MicroBatcher(
+        answer_batch, max_batch_size=CONFIG.get('max_batch_size', 1),
+        max_wait=CONFIG.get('max_batch_wait_ms', 0) / 1000, name='answer_batch', logger=app.logger).start()
+
+
+def convert_to_safetensors(model_path):
+    GPT2LMHeadModel.from_pretrained(model_path).save_pretrained(model_path, safe_serialization=True)
+
+
 def main():
-    np.random.seed(42)
-    torch.manual_seed(42)
+    seed(42)
 
     parser = argparse.ArgumentParser('Entry point for chat-bot')
     parser.add_argument('--config-path', help='config path')
     parser.add_argument('--port', help='port')
+    parser.add_argument('--convert-safetensors', action='store_true', help='save the weights as model.safetensors and exit')
+    parser.add_argument('--workers', type=int, help='pre-forked worker processes, 0 for the threaded dev server; '
+                                                    'serving.workers of the config by default')
     args = parser.parse_args()
 
-    global TOK, MODEL, CONFIG
     with open(args.config_path) as f:
-        CONFIG = json.load(f)
+        config = json.load(f)
+
+    if args.convert_safetensors:
+        convert_to_safetensors(config['model_path'])
+        return
+
+    setup_logging(config.get('logging'), config['name'], [app.logger])
+    registry_conf = config['service_registry']
+    serving_conf = config.get('serving', {})
+    workers = args.workers if args.workers is not None else serving_conf.get('workers', 0)
+    if not workers:
+        READINESS.start(lambda: load(config))
+        registry = ServiceRegistryClient(registry_conf['conf'], registry_conf['url'], logger=app.logger, ready=READINESS.is_ready)
+        registry.start()
+        app.run(host='0.0.0.0', port=args.port, threaded=True)
+        return
+
+    if workers > 1 and config.get('prefix_cache'):
+        # every worker would cache its own states, and the turns of a uid land on any of them
+        app.logger.warning('The prompt state cache is off with %s pre-forked workers', workers)
+        config = dict(config, prefix_cache=None)
+
+    # the master loads once, the workers share the weights copy-on-write
+    load(config, serve=False)
 
-    TOK = GPT2Tokenizer.from_pretrained(CONFIG['model_path'])
-    MODEL = GPT2LMHeadModel.from_pretrained(CONFIG['model_path'])
+    def init_worker(i, cores):
+        # a worker runs one intra-op thread per core it is pinned to, whatever intra_op_threads
+        # says; the inter-op pool was sized by the master's load and cannot be changed again
+        configure_threads(len(cores))
+        seed(42 + i)
+        READINESS.start(start_serving)
+        if i == 0:
+            # registered once, as soon as the first worker can answer
+            registry = ServiceRegistryClient(
+                registry_conf['conf'], registry_conf['url'], logger=app.logger, ready=READINESS.is_ready)
+            registry.start()
+        # the socket is shared: a worker that accepted while warming up would answer 503s for the
+        # whole node, and a late or restarted one would trip the aggregator's circuit breaker
+        if not READINESS.wait():
+            raise RuntimeError('Worker {} failed to start'.format(i))
 
-    registry_conf = CONFIG['service_registry']
-    registry = ServiceRegistryClient(registry_conf['conf'], registry_conf['url'], logger=app.logger)
-    registry.start()
-    app.run(host='0.0.0.0', port=args.port, threaded=True)
+    server = PreforkServer(app, '0.0.0.0', int(args.port), workers, init_worker,
+                           serving_conf.get('cores_per_worker'), logger=app.logger)
+    server.serve_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+import gc
+import os
+import time
+import signal
+import logging
+
+from werkzeug.serving import make_server
+
+
+class PreforkServer:
+    """Serves a WSGI app from `workers` forked processes sharing one listening socket.
+
+    Everything loaded before `serve_forever` (model weights, tokenizer,
+    validators) is shared by the workers copy-on-write; gc.freeze keeps the
+    garbage collector from writing to those pages. Every worker is pinned
+    to its own `cores_per_worker` cores, and `init_worker(index, cores)`
+    runs in it before it starts accepting. Workers that die are restarted.
+    """
+
+    def __init__(self, app, host, port, workers, init_worker=None, cores_per_worker=None, logger=None):
+        self.__app = app
+        self.__host = host
+        self.__port = port
+        self.__workers = workers
+        self.__init_worker = init_worker
+        self.__logger = logger or logging.getLogger('PreforkServer')
+        self.__cores = self.split_cores(workers, cores_per_worker)
+        self.__pids = {}
+        self.__stopping = False
+        self.__server = None
+
+    @staticmethod
+    def split_cores(workers, cores_per_worker=None):
+        available = sorted(os.sched_getaffinity(0))
+        per_worker = cores_per_worker or max(len(available) // workers, 1)
+        return [[available[(i * per_worker + j) % len(available)] for j in range(per_worker)] for i in range(workers)]
+
+    def serve_forever(self):
+        self.__server = make_server(self.__host, self.__port, self.__app, threaded=True)
+        gc.collect()
+        gc.freeze()
+        for i in range(self.__workers):
+            self.__spawn(i)
+
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+        while self.__pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            i = self.__pids.pop(pid, None)
+            if i is None or self.__stopping:
+                continue
+            self.__logger.error('Worker %s (pid %s) exited with status %s, restarting', i, pid, status)
+            time.sleep(1)
+            self.__spawn(i)
+
+    def __spawn(self, i):
+        pid = os.fork()
+        if pid:
+            self.__pids[pid] = i
+            self.__logger.info('Started worker %s (pid %s) on cores %s', i, pid, self.__cores[i])
+            return
+
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.sched_setaffinity(0, self.__cores[i])
+            if self.__init_worker:
+                self.__init_worker(i, self.__cores[i])
+            self.__server.serve_forever()
+            code = 0
+        except BaseException as e:
+            self.__logger.exception('Worker %s failed: %s', i, repr(e))
+        finally:
+            os._exit(code)
+
+    def __stop(self, signum, frame):
+        self.__stopping = True
+        for pid in list(self.__pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
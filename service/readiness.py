@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from flask import Response
+
+
+def load_parallel(loaders, logger=None):
+    """Runs independent loaders (name -> callable) in threads.
+
+    Returns name -> result, and re-raises the first exception of a loader.
+    """
+    logger = logger or logging.getLogger('load_parallel')
+    results = {}
+    errors = {}
+
+    def run(name, loader):
+        started = time.time()
+        try:
+            results[name] = loader()
+            logger.info('Loaded %s in %.2fs', name, time.time() - started)
+        except Exception as e:
+            errors[name] = e
+
+    threads = [threading.Thread(target=run, args=(name, loader), name='load_{}'.format(name)) for name, loader in loaders.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for name, e in errors.items():
+        raise RuntimeError('Loading {} failed'.format(name)) from e
+    return results
+
+
+class Readiness:
+    """Runs the slow start-up work in the background and reports when it is done.
+
+    The cold start is counted from the creation, or, in a forked worker, from
+    the fork, so every pre-forked worker reports its own.
+    """
+
+    def __init__(self, logger=None):
+        self.__started = time.time()
+        self.__ready_at = None
+        self.__error = None
+        self.__event = threading.Event()
+        self.__logger = logger or logging.getLogger('Readiness')
+        os.register_at_fork(after_in_child=self.__forked)
+
+    def __forked(self):
+        self.__started = time.time()
+        self.__ready_at = None
+        self.__error = None
+        self.__event = threading.Event()
+
+    def start(self, load):
+        thread = threading.Thread(target=self.__run, args=(load,), name='readiness')
+        thread.daemon = True
+        thread.start()
+
+    def __run(self, load):
+        try:
+            load()
+            self.__ready_at = time.time()
+            self.__logger.info('Ready, cold start took %.2fs', self.cold_start_seconds())
+        except Exception as e:
+            self.__error = e
+            self.__logger.exception('Start-up failed: %s', repr(e))
+        finally:
+            self.__event.set()
+
+    def is_ready(self):
+        return self.__ready_at is not None
+
+    def wait(self, timeout=None):
+        self.__event.wait(timeout)
+        return self.is_ready()
+
+    def cold_start_seconds(self):
+        if self.__ready_at is None:
+            return None
+        return self.__ready_at - self.__started
+
+    def status(self):
+        status = {'ready': self.is_ready(), 'cold_start_seconds': self.cold_start_seconds()}
+        if self.__error is not None:
+            status['error'] = repr(self.__error)
+        return status
+
+    def not_ready_response(self):
+        return Response(json.dumps(self.status(), ensure_ascii=False), status=503)
+
+    def register_endpoint(self, app):
+        def ready():
+            if not self.is_ready():
+                return self.not_ready_response()
+            return json.dumps(self.status(), ensure_ascii=False)
+
+        app.add_url_rule('/ready', 'ready', ready, methods=['GET'])
@@ -0,0 +1,216 @@
+import os
+import json
+import math
+import time
+import random
+import argparse
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from cache import normalize_query
+
+
+# files of an index directory; the arrays are memory-mapped when it is opened
+VOCAB_FILE = 'vocab.json'
+ARRAY_FILES = ('idf', 'indptr', 'indices', 'data', 'answer_offsets')
+ANSWERS_FILE = 'answers.bin'
+
+
+def tokenize(text):
+    """Words plus character trigrams of the words, so "дела" still matches "делах"."""
+    terms = []
+    for word in normalize_query(text).split():
+        terms.append(word)
+        padded = '^{}$'.format(word)
+        terms += ['#' + padded[i:i + 3] for i in range(len(padded) - 2)]
+    return terms
+
+
+def read_pairs(path):
+    """(question, answer) pairs from a q;a; csv like test_ans40.csv, or from
+    dialogues of "- " lines like train.txt, where every turn answers the
+    previous one and any other line starts a new dialogue."""
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            for line in f:
+                parts = line.rstrip('\n').split(';')
+                if len(parts) >= 2 and parts[0].strip() and parts[1].strip():
+                    yield parts[0].strip(), parts[1].strip()
+            return
+
+        previous = None
+        for line in f:
+            line = line.strip()
+            if not line.startswith('-'):
+                previous = None
+                continue
+            turn = line.lstrip('- ').strip()
+            if previous and turn:
+                yield previous, turn
+            previous = turn or None
+
+
+def build_index(pairs, path, max_df=0.1):
+    """Writes a TF-IDF index of the questions in `pairs` to directory `path`.
+
+    The matrix is stored column-wise (CSC): for every term, the questions
+    that contain it and their weights, so a query touches only the postings
+    of its own terms. Terms found in more than `max_df` of the questions
+    carry little signal and are dropped.
+    """
+    vocab = {}
+    docs, terms, counts = array('i'), array('i'), array('f')
+    answers = []
+    for question, answer in pairs:
+        question_terms = Counter(tokenize(question))
+        if not question_terms:
+            continue
+        for term, count in question_terms.items():
+            docs.append(len(answers))
+            terms.append(vocab.setdefault(term, len(vocab)))
+            counts.append(count)
+        answers.append(answer)
+
+    n_docs = len(answers)
+    docs = np.frombuffer(docs, dtype=np.int32)
+    terms = np.frombuffer(terms, dtype=np.int32)
+    counts = np.frombuffer(counts, dtype=np.float32)
+
+    df = np.bincount(terms, minlength=len(vocab))
+    keep = df <= max(max_df * n_docs, 1)
+    term_ids = np.cumsum(keep) - 1
+    idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+
+    mask = keep[terms]
+    docs, terms, counts = docs[mask], terms[mask], counts[mask]
+    weights = (1 + np.log(counts)) * idf[terms]
+    norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=n_docs))
+    weights = weights / np.maximum(norms[docs], 1e-12)
+    terms = term_ids[terms]
+    order = np.lexsort((docs, terms))
+    indptr = np.zeros(int(keep.sum()) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=len(indptr) - 1), out=indptr[1:])
+
+    encoded = [answer.encode('utf-8') for answer in answers]
+    answer_offsets = np.zeros(n_docs + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in encoded], out=answer_offsets[1:])
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'idf': idf[keep], 'indptr': indptr, 'indices': docs[order].astype(np.int32),
+        'data': weights[order].astype(np.float32), 'answer_offsets': answer_offsets,
+    }
+    for name, value in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), value)
+    with open(os.path.join(path, ANSWERS_FILE), 'wb') as f:
+        f.write(b''.join(encoded))
+    with open(os.path.join(path, VOCAB_FILE), 'w', encoding='utf-8') as f:
+        # dropped terms map to -1, so queries know to ignore them rather than treat them as unseen
+        json.dump({term: int(term_ids[i]) if keep[i] else -1 for term, i in vocab.items()}, f, ensure_ascii=False)
+    return n_docs
+
+
+class RetrievalIndex:
+    """Answers a query with the answers to the most similar known questions."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, VOCAB_FILE), encoding='utf-8') as f:
+            self.__vocab = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAY_FILES}
+        self.__idf = np.asarray(arrays['idf'])
+        self.__indptr = np.asarray(arrays['indptr'])
+        self.__indices = arrays['indices']
+        self.__data = arrays['data']
+        self.__answer_offsets = arrays['answer_offsets']
+        self.__answers = np.memmap(os.path.join(path, ANSWERS_FILE), dtype=np.uint8, mode='r') \
+            if self.__answer_offsets[-1] else np.zeros(0, dtype=np.uint8)
+        self.__max_idf = float(self.__idf.max()) if len(self.__idf) else 1.0
+
+    def __len__(self):
+        return len(self.__answer_offsets) - 1
+
+    def answer(self, doc):
+        start, end = self.__answer_offsets[doc], self.__answer_offsets[doc + 1]
+        return bytes(self.__answers[start:end]).decode('utf-8')
+
+    def search(self, query, k=5):
+        """Returns up to `k` (cosine similarity, question id) pairs, best first."""
+        ids, weights = [], []
+        norm = 0.0
+        for term, count in Counter(tokenize(query)).items():
+            term_id = self.__vocab.get(term)
+            if term_id == -1:
+                continue
+            # unknown terms still count in the norm, as if they were the rarest ones
+            idf = self.__idf[term_id] if term_id is not None else self.__max_idf
+            weight = (1 + math.log(count)) * idf
+            norm += weight * weight
+            if term_id is not None:
+                ids.append(term_id)
+                weights.append(weight)
+        if not ids:
+            return []
+
+        ids = np.asarray(ids)
+        starts = self.__indptr[ids]
+        lengths = self.__indptr[ids + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return []
+        # positions of all the postings of the query terms, gathered in one go
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        postings = offsets + np.arange(total)
+        products = self.__data[postings] * np.repeat(np.asarray(weights, dtype=np.float32), lengths)
+        candidates, positions = np.unique(self.__indices[postings], return_inverse=True)
+        scores = np.bincount(positions, weights=products) / math.sqrt(norm)
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(candidates[i])) for i in top]
+
+    def reply(self, query, min_score=0.3, top_k=3):
+        """A random answer among the `top_k` best questions scoring at least `min_score`, or None."""
+        found = [doc for score, doc in self.search(query, top_k) if score >= min_score]
+        if not found:
+            return None
+        return self.answer(random.choice(found))
+
+
+def main():
+    parser = argparse.ArgumentParser('TF-IDF retrieval index of dialogue pairs for the aggregator fallback')
+    subparsers = parser.add_subparsers(dest='command')
+    build = subparsers.add_parser('build', help='build an index')
+    build.add_argument('--input', action='append', required=True,
+                       help='q;a; csv or "- " dialogue text file, may be repeated')
+    build.add_argument('--output', required=True, help='index directory')
+    build.add_argument('--max-df', type=float, default=0.1, help='drop terms found in more of the questions')
+    query = subparsers.add_parser('query', help='answer queries from the command line')
+    query.add_argument('--index', required=True, help='index directory')
+    query.add_argument('queries', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        started = time.time()
+        pairs = (pair for path in args.input for pair in read_pairs(path))
+        count = build_index(pairs, args.output, args.max_df)
+        print('Indexed {} pairs in {:.1f}s'.format(count, time.time() - started))
+    elif args.command == 'query':
+        index = RetrievalIndex(args.index)
+        for q in args.queries:
+            started = time.time()
+            found = index.search(q)
+            elapsed = time.time() - started
+            print('{} ({:.3f}ms)'.format(q, elapsed * 1000))
+            for score, doc in found:
+                print('  {:.3f} {}'.format(score, index.answer(doc)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
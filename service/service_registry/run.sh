@@ -2,4 +2,4 @@
 
 source env/bin/activate
 
-python ../service_registry_api.py --port 50003
\ No newline at end of file
+python ../service_registry_api.py --port 50003 --lifetime 150
\ No newline at end of file
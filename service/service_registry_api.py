@@ -1,61 +1,143 @@
 import time
 import sys
+import heapq
 
 import flask
 import json
 
 import argparse
 from flask import request, jsonify, Response
-from threading import Lock
+from threading import Lock, Condition
+from collections import Counter as CountOf
+
+from metrics import REGISTRY, Counter, Gauge
+from logs import setup_logging, add_logging_arguments, logging_conf_from_args
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = True
+REGISTRY.register_endpoint(app)
+
+REGISTRATIONS = Counter('registry_registrations_total', 'Register requests', ['name'])
 
 
 class AvailableServices:
+    """Registered services with a version that grows on every change.
+
+    The snapshot (and its json) is rebuilt only when a service appears,
+    changes its conf or expires, so reading an unchanged registry is free.
+    """
+
     def __init__(self, lifetime = 60 * 60 * 10):
         self.__lock = Lock()
+        self.__changed = Condition(self.__lock)
         self.__lifetime = lifetime
         self.__services = {}
-        self.__services_update_time = {}
+        self.__expires_at = {}
+        self.__expiry_heap = []
+        self.__version = 0
+        self.__snapshot = []
+        self.__snapshot_json = '[]'
 
     def update_service_conf(self, service_conf):
         url = service_conf['url']
+        now = time.time()
         with self.__lock:
+            self.__evict(now)
+            if url not in self.__services:
+                heapq.heappush(self.__expiry_heap, (now + self.__lifetime, url))
+            changed = self.__services.get(url) != service_conf
             self.__services[url] = service_conf
-            self.__services_update_time[url] = time.time()
+            self.__expires_at[url] = now + self.__lifetime
+            if changed:
+                self.__bump()
+
+    def __evict(self, now):
+        evicted = False
+        while self.__expiry_heap and self.__expiry_heap[0][0] <= now:
+            _, url = heapq.heappop(self.__expiry_heap)
+            expires_at = self.__expires_at[url]
+            if expires_at > now:
+                heapq.heappush(self.__expiry_heap, (expires_at, url))
+                continue
+            del self.__services[url]
+            del self.__expires_at[url]
+            evicted = True
+        if evicted:
+            self.__bump()
+
+    def __bump(self):
+        self.__version += 1
+        self.__snapshot = list(self.__services.values())
+        self.__snapshot_json = json.dumps(self.__snapshot, ensure_ascii=False)
+        self.__changed.notify_all()
 
     def get(self):
-        services = []
         with self.__lock:
-            for url, service_conf in self.__services.items():
-                update_time = self.__services_update_time.get(url, 0)
-                if time.time() - update_time > self.__lifetime:
-                    continue
-                services.append(service_conf)
-        return services
+            self.__evict(time.time())
+            return self.__snapshot
+
+    @property
+    def version(self):
+        return self.__version
+
+    def get_json(self):
+        with self.__lock:
+            self.__evict(time.time())
+            return self.__snapshot_json
+
+    def watch_json(self, since, timeout):
+        """Waits up to `timeout` seconds for a version other than `since`."""
+        deadline = time.time() + timeout
+        with self.__lock:
+            while True:
+                now = time.time()
+                self.__evict(now)
+                if self.__version != since or now >= deadline:
+                    break
+                wait = deadline - now
+                if self.__expiry_heap:
+                    wait = min(wait, self.__expiry_heap[0][0] - now)
+                self.__changed.wait(wait)
+            return '{{"version": {}, "services": {}}}'.format(self.__version, self.__snapshot_json)
 
 
 AVAILABLE_SERVICES = AvailableServices()
+MAX_WATCH_TIMEOUT = 60
+
+Gauge('registry_services', 'Registered replicas by service name', ['name'],
+      callback=lambda: {(name,): count for name, count in CountOf(s['name'] for s in AVAILABLE_SERVICES.get()).items()})
+Gauge('registry_version', 'Version of the registry snapshot', callback=lambda: AVAILABLE_SERVICES.version)
 
 @app.route('/get', methods=['GET'])
 def get_api():
     try:
         app.logger.debug('New get request')
-        services = AVAILABLE_SERVICES.get()
-        app.logger.debug('Got get result: %s', str(services))
-        return json.dumps(services, ensure_ascii=False)
+        services = AVAILABLE_SERVICES.get_json()
+        app.logger.debug('Got get result: %s', services)
+        return services
     except Exception as e:
         app.logger.exception('Got exception during /get: %s', repr(e))
         return json.dumps({'error': repr(e)}, ensure_ascii=False)
 
 
+@app.route('/watch', methods=['GET'])
+def watch_api():
+    try:
+        since = int(request.args.get('since', -1))
+        timeout = min(float(request.args.get('timeout', 30)), MAX_WATCH_TIMEOUT)
+        return AVAILABLE_SERVICES.watch_json(since, timeout)
+    except Exception as e:
+        app.logger.exception('Got exception during /watch: %s', repr(e))
+        return Response(json.dumps({'error': repr(e)}, ensure_ascii=False), status=500)
+
+
 @app.route('/register', methods=['POST'])
 def register_api():
     req = request.json
     app.logger.debug('New register request: %s', req)
     try:
         AVAILABLE_SERVICES.update_service_conf(req)
+        REGISTRATIONS.inc(name=req.get('name', ''))
         app.logger.debug('Successful register for request: %s', req)
         return json.dumps(req, ensure_ascii=False)
     except Exception as e:
@@ -80,7 +162,13 @@ def shutdown():
 def main():
     parser = argparse.ArgumentParser('Entry point for chat-bot')
     parser.add_argument('--port', help='port')
+    parser.add_argument('--lifetime', type=float, default=60 * 60 * 10, help='seconds a registration stays valid')
+    add_logging_arguments(parser)
     args = parser.parse_args()
+    setup_logging(logging_conf_from_args(args), 'service_registry', [app.logger])
+
+    global AVAILABLE_SERVICES
+    AVAILABLE_SERVICES = AvailableServices(args.lifetime)
 
     app.run(host='0.0.0.0', port=args.port, threaded=True)
 
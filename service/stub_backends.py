@@ -0,0 +1,227 @@
+import json
+import time
+import socket
+import random
+import logging
+import threading
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import flask
+from flask import request
+from werkzeug.serving import make_server
+
+from wire import read_request, response
+
+
+DISTRIBUTIONS = ('uniform', 'exponential', 'lognormal')
+
+
+def sample_latency(distribution, latency, jitter):
+    if distribution == 'exponential':
+        return latency + (random.expovariate(1 / jitter) if jitter else 0)
+    if distribution == 'lognormal':
+        return latency * random.lognormvariate(0, jitter)
+    return latency + random.random() * jitter
+
+
+class StubBackend:
+    """Local stand-in for a model/wiki backend, used by the benchmarks.
+
+    Answers `/api` like model_api does, after sleeping for a latency drawn
+    from `distribution`:
+
+    - 'uniform': `latency` plus up to `jitter` more
+    - 'exponential': `latency` plus an exponential tail with mean `jitter`
+    - 'lognormal': `latency` is the median and `jitter` the sigma of the log
+
+    `failure_rate` of the answers are `ok: False`. With `capacity` only
+    that many requests are served at once and the rest queue, like a
+    CPU-bound model does under overload.
+    """
+
+    def __init__(self, name, latency=0.05, jitter=0.0, failure_rate=0.0, capacity=None, distribution='uniform',
+                 host='127.0.0.1', port=0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError('Unknown latency distribution {}'.format(distribution))
+        self.name = name
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__distribution = distribution
+        self.__failure_rate = failure_rate
+        self.__capacity = threading.Semaphore(capacity) if capacity else None
+
+        app = flask.Flask('stub_{}'.format(name))
+        app.add_url_rule('/api', 'api', self.__api, methods=['POST'])
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        self.__server = make_server(host, port, app, threaded=True)
+        self.url = 'http://{}:{}/api'.format(host, self.__server.server_port)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='stub_{}'.format(name))
+        self.__thread.daemon = True
+
+    def __api(self):
+        req = read_request()
+        latency = sample_latency(self.__distribution, self.__latency, self.__jitter)
+        if self.__capacity is not None:
+            with self.__capacity:
+                time.sleep(latency)
+        else:
+            time.sleep(latency)
+        if random.random() < self.__failure_rate:
+            return response({'uid': req['uid'], 'from': self.name, 'ok': False, 'error': 'stub failure'})
+        return response({'uid': req['uid'], 'from': self.name, 'ok': True, 'reply': 'stub reply'})
+
+    def service_conf(self, priority, timeout=5, history_len=0, encodings=('msgpack', 'json')):
+        return {'name': self.name, 'url': self.url, 'priority': priority, 'timeout': timeout, 'history_len': history_len,
+                'encodings': list(encodings)}
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+
+
+class StubTelegram:
+    """Local stand-in for the Telegram Bot API, used by bench_bot.
+
+    Releases `messages` (a list of (user_id, text)) at `rps` per second,
+    through getUpdates or, with `webhook_url`, by posting them to the bot
+    like Telegram does with up to `max_connections` at once. Every
+    sendMessage is matched to the oldest unanswered message of its chat.
+    """
+
+    def __init__(self, messages, rps, webhook_url=None, max_connections=40, host='127.0.0.1', port=0):
+        self.__messages = messages
+        self.__rps = rps
+        self.__webhook_url = webhook_url
+        self.__max_connections = max_connections
+        self.__updates = []
+        self.__pending = defaultdict(deque)
+        self.__cond = threading.Condition()
+        self.latencies = []
+        self.replies = []
+
+        app = flask.Flask('stub_telegram')
+        app.add_url_rule('/bot<token>/<method>', 'method', self.__method, methods=['GET', 'POST'])
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        self.__server = make_server(host, port, app, threaded=True)
+        self.api_url = 'http://{}:{}/bot{{0}}/{{1}}'.format(host, self.__server.server_port)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='stub_telegram')
+        self.__thread.daemon = True
+
+    @staticmethod
+    def __ok(result):
+        return json.dumps({'ok': True, 'result': result}, ensure_ascii=False)
+
+    def __method(self, token, method):
+        if method == 'getUpdates':
+            return self.__ok(self.__get_updates(int(request.values.get('offset', 0)),
+                                                float(request.values.get('timeout', 0))))
+        if method == 'sendMessage':
+            chat_id = int(request.values['chat_id'])
+            now = time.time()
+            with self.__cond:
+                if self.__pending[chat_id]:
+                    self.latencies.append(now - self.__pending[chat_id].popleft())
+                self.replies.append(request.values['text'])
+            return self.__ok({'message_id': 1, 'date': int(now), 'chat': {'id': chat_id, 'type': 'private'},
+                              'text': request.values['text']})
+        return self.__ok(True)
+
+    def __get_updates(self, offset, timeout):
+        deadline = time.time() + min(timeout, 1)
+        with self.__cond:
+            while len(self.__updates) < offset and time.time() < deadline:
+                self.__cond.wait(deadline - time.time())
+            return self.__updates[max(offset - 1, 0):]
+
+    @staticmethod
+    def __update(update_id, user_id, text):
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'user{}'.format(user_id)}
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'from': user,
+            'chat': {'id': user_id, 'type': 'private'}, 'text': text}}
+
+    def send_all(self):
+        """Releases all the messages at the configured rate and returns when the last one was released."""
+        executor = ThreadPoolExecutor(self.__max_connections) if self.__webhook_url else None
+        session = requests.Session()
+        started = time.time()
+        for i, (user_id, text) in enumerate(self.__messages):
+            time.sleep(max(started + i / self.__rps - time.time(), 0))
+            update = self.__update(i + 1, user_id, text)
+            with self.__cond:
+                self.__pending[user_id].append(time.time())
+                if executor is None:
+                    self.__updates.append(update)
+                    self.__cond.notify_all()
+            if executor is not None:
+                executor.submit(session.post, self.__webhook_url, json=update, timeout=60)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def wait_replies(self, timeout):
+        deadline = time.time() + timeout
+        while len(self.replies) < len(self.__messages) and time.time() < deadline:
+            time.sleep(0.1)
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+
+
+def free_port(host='127.0.0.1'):
+    s = socket.socket()
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def serve_forever(name, port, **kwargs):
+    backend = StubBackend(name, port=port, **kwargs)
+    backend.start()
+    while True:
+        time.sleep(3600)
+
+
+class StubProcess:
+    """Runs a StubBackend in a child process so it does not share the GIL with the load generator."""
+
+    def __init__(self, name, host='127.0.0.1', **kwargs):
+        self.name = name
+        port = free_port(host)
+        self.url = 'http://{}:{}/api'.format(host, port)
+        kwargs['host'] = host
+        self.__process = multiprocessing.Process(target=serve_forever, args=(name, port), kwargs=kwargs)
+        self.__process.daemon = True
+        self.__host = host
+        self.__port = port
+
+    def service_conf(self, priority, timeout=5, history_len=0, encodings=('msgpack', 'json')):
+        return {'name': self.name, 'url': self.url, 'priority': priority, 'timeout': timeout, 'history_len': history_len,
+                'encodings': list(encodings)}
+
+    def start(self, wait=10):
+        self.__process.start()
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            try:
+                socket.create_connection((self.__host, self.__port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Stub backend {} did not start'.format(self.name))
+
+    def stop(self):
+        self.__process.terminate()
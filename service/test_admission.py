@@ -0,0 +1,41 @@
+import random
+
+from admission import AdaptiveLimit
+
+
+def replay(limit, latencies, requests):
+    for _ in range(requests):
+        limit.acquire()
+        for backend, (name, latency) in latencies.items():
+            limit.observe(backend, latency * random.lognormvariate(0, 0.2), name)
+        limit.release()
+
+
+def test_limit_goes_down_when_one_backend_degrades_and_another_stays_fast():
+    random.seed(0)
+    limit = AdaptiveLimit(initial_limit=100, min_limit=10, max_limit=1000)
+    healthy = {'wiki:1': ('wiki', 0.1), 'model:1': ('model-40', 0.5)}
+    replay(limit, healthy, 200)
+    before = limit.limit
+
+    replay(limit, {'wiki:1': ('wiki', 0.1), 'model:1': ('model-40', 5.0)}, 300)
+    assert limit.limit < before / 2
+
+
+def test_backends_not_named_in_the_config_do_not_move_the_limit():
+    random.seed(0)
+    limit = AdaptiveLimit(initial_limit=100, min_limit=10, max_limit=1000, backends=['model-40'])
+    replay(limit, {'wiki:1': ('wiki', 0.1), 'model:1': ('model-40', 0.5)}, 200)
+    before = limit.limit
+
+    replay(limit, {'wiki:1': ('wiki', 2.0), 'model:1': ('model-40', 0.5)}, 300)
+    assert limit.limit >= before
+
+
+def test_static_limit_stays_put():
+    limit = AdaptiveLimit()
+    limit.configure(50, 50, 50)
+    replay(limit, {'model:1': ('model-40', 0.5)}, 50)
+    replay(limit, {'model:1': ('model-40', 5.0)}, 50)
+    assert limit.limit == 50
+    assert limit.in_flight == 0
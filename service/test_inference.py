@@ -0,0 +1,30 @@
+import os
+import pickle
+
+import torch
+
+from inference import seed
+
+
+def sample_in_worker(i):
+    """Forks like PreforkServer does, seeds like model_api's init_worker and returns what the worker samples."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        seed(42 + i)
+        probs = torch.full((1, 1000), 1 / 1000)
+        os.write(write, pickle.dumps(torch.multinomial(probs, 10, replacement=True).tolist()))
+        os._exit(0)
+
+    os.close(write)
+    with os.fdopen(read, 'rb') as f:
+        samples = pickle.loads(f.read())
+    os.waitpid(pid, 0)
+    return samples
+
+
+def test_pre_forked_workers_sample_differently():
+    seed(42)
+    assert sample_in_worker(0) != sample_in_worker(1)
+    assert sample_in_worker(0) == sample_in_worker(0)
@@ -20,7 +20,7 @@ python3.7 -m pip install virtualenv -q
 python3.7 -m venv env
 source env/bin/activate
 
-pip install deeppavlov==0.14.1 Flask==1.0.2
+pip install deeppavlov==0.14.1 Flask==1.0.2 msgpack==1.0.2
 
 python -m deeppavlov install kbqa_cq_rus -d
 
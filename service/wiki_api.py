@@ -1,49 +1,114 @@
 import sys
+import time
 import flask
 import json
 import argparse
 
-from functools import lru_cache
-
 from flask import request
 from deeppavlov import build_model, configs
 
 from client import ServiceRegistryClient
+from readiness import Readiness
+from cache import AnswerCache, normalize_query
+from batching import MicroBatcher, DeadlineExceeded
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from logs import setup_logging
+from wire import read_request, response
 
 
 app = flask.Flask(__name__)
 #app.config["DEBUG"] = True
-
-#KBQA_MODEL = build_model(configs.kbqa.kbqa_cq_rus, download=True)
-KBQA_MODEL = build_model(configs.kbqa.kbqa_cq_rus, load_trained=True)
-CACHE_SIZE = 100000
+READINESS = Readiness(logger=app.logger)
+READINESS.register_endpoint(app)
+REGISTRY.register_endpoint(app)
+
+ANSWER_LATENCY = Histogram('wiki_answer_seconds', 'Time to answer a request, cache hits included')
+KBQA_LATENCY = Histogram('wiki_kbqa_seconds', 'Time of one KBQA call for a batch')
+ANSWERS = Counter('wiki_answers_total', 'Answers by whether the knowledge base knew the answer', ['found'])
+ABANDONED = Counter('wiki_abandoned_total', 'Requests given up after their deadline, by stage', ['stage'])
+Gauge('wiki_cold_start_seconds', 'Seconds from process start to ready', callback=READINESS.cold_start_seconds)
+Gauge('wiki_queue_size', 'Cache misses waiting for a batch', callback=lambda: BATCHER.queue_size if BATCHER else 0)
+Gauge('wiki_cache_hit_ratio', 'Hit ratio of the answer cache', callback=lambda: CACHE.stats()['hit_ratio'] if CACHE else 0)
+Gauge('wiki_cache_entries', 'Answers in the in-memory cache',
+      callback=lambda: CACHE.stats()['memory_entries'] if CACHE else 0)
+
+KBQA_MODEL = None
+NOT_FOUND = 'Not Found'
+CACHE = None
+BATCHER = None
 
 CONFIG = None
 
 
-@lru_cache(maxsize=CACHE_SIZE)
-def get_wiki_answer(query):
-    return KBQA_MODEL([query])[0]
+def load():
+    global KBQA_MODEL, BATCHER
+    #KBQA_MODEL = build_model(configs.kbqa.kbqa_cq_rus, download=True)
+    KBQA_MODEL = build_model(configs.kbqa.kbqa_cq_rus, load_trained=True)
+    CACHE.evict_expired()
+
+    batching_conf = CONFIG.get('batching', {})
+    BATCHER = MicroBatcher(
+        answer_batch, max_batch_size=batching_conf.get('max_batch_size', 1),
+        max_wait=batching_conf.get('max_wait_ms', 0) / 1000, name='answer_batch', logger=app.logger).start()
+
+
+def answer_batch(items):
+    """`items` are (cache key, query) pairs of different cache misses."""
+    started = time.time()
+    replies = KBQA_MODEL([query for _, query in items])
+    KBQA_LATENCY.observe(time.time() - started)
+    for (key, _), reply in zip(items, replies):
+        CACHE.put(key, reply)
+    return replies
+
+
+def get_wiki_answer(query, deadline=None):
+    key = normalize_query(query)
+    found, reply = CACHE.get(key)
+    if found:
+        return reply
+
+    return BATCHER.submit((key, query), key=key, deadline=deadline).result()
 
 
 @app.route('/api', methods=['POST'])
 def home():
-    req = request.json
+    if not READINESS.is_ready():
+        return READINESS.not_ready_response()
+    req = read_request()
     app.logger.debug('Got request: %s', req)
     query = req['query']
     uid = req['uid']
 
+    deadline = req.get('deadline')
+    if deadline is not None and deadline <= time.time():
+        ABANDONED.inc(stage='arrival')
+        return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': 'Deadline exceeded'})
+
     try:
-        reply = get_wiki_answer(query)
-        if reply == 'Not Found':
+        started = time.time()
+        reply = get_wiki_answer(query, deadline)
+        latency = time.time() - started
+        ANSWER_LATENCY.observe(latency)
+        ANSWERS.inc(found=str(reply != NOT_FOUND).lower())
+        app.logger.info('Answered', extra={'uid': uid, 'latency': latency, 'status': 'found' if reply != NOT_FOUND else 'not_found'})
+        if reply == NOT_FOUND:
             app.logger.debug('Got Not Fount for uid %s', uid)
-            return json.dumps({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': reply}, ensure_ascii=False)
+            return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': reply})
 
         app.logger.debug('Reply %s for uid %s', reply, uid)
-        return json.dumps({'uid': uid, 'from': CONFIG['name'], 'ok': True, 'reply': reply}, ensure_ascii=False)
+        return response({'uid': uid, 'from': CONFIG['name'], 'ok': True, 'reply': reply})
+    except DeadlineExceeded:
+        ABANDONED.inc(stage='queue')
+        return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': 'Deadline exceeded'})
     except Exception as e:
-        app.logger.exception('Exception %s for uid %s', uid, repr(e))
-        return json.dumps({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': repr(e)}, ensure_ascii=False)
+        app.logger.exception('Exception %s for uid %s', repr(e), uid, extra={'uid': uid})
+        return response({'uid': uid, 'from': CONFIG['name'], 'ok': False, 'error': repr(e)})
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return json.dumps(CACHE.stats(), ensure_ascii=False)
 
 
 def shutdown_server():
@@ -65,12 +130,16 @@ def main():
     parser.add_argument('--port', help='port')
     args = parser.parse_args()
 
-    global CONFIG
+    global CONFIG, CACHE
     with open(args.config_path) as f:
         CONFIG = json.load(f)
+    setup_logging(CONFIG.get('logging'), CONFIG['name'], [app.logger])
+    CACHE = AnswerCache(negative_value=NOT_FOUND, **CONFIG.get('cache', {}))
+
+    READINESS.start(load)
 
     registry_conf = CONFIG['service_registry']
-    registry = ServiceRegistryClient(registry_conf['conf'], registry_conf['url'], logger=app.logger)
+    registry = ServiceRegistryClient(registry_conf['conf'], registry_conf['url'], logger=app.logger, ready=READINESS.is_ready)
     registry.start()
     app.run(host='0.0.0.0', port=args.port, threaded=True)
 
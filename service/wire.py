@@ -0,0 +1,115 @@
+import json
+
+import flask
+from flask import request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+# what callers accept back; backends without msgpack ignore it and answer json
+ACCEPT = '{}, {};q=0.5'.format(MSGPACK, JSON) if msgpack else JSON
+
+# fields of a backend request that differ between the services of one fan-out
+PER_SERVICE_FIELDS = ('history', 'deadline')
+
+
+def encoding_for(service):
+    """msgpack for services that list it in the "encodings" of their conf, json for the rest."""
+    if msgpack is not None and 'msgpack' in service.get('encodings', ()):
+        return MSGPACK
+    return JSON
+
+
+def _msgpack_map_header(size):
+    if size < 16:
+        return bytes([0x80 | size])
+    if size < 1 << 16:
+        return b'\xde' + size.to_bytes(2, 'big')
+    return b'\xdf' + size.to_bytes(4, 'big')
+
+
+def _encode_fields(fields, encoding):
+    # an encoded map without its header (or braces) is just its keys and
+    # values, so the fields of two maps can be concatenated into one
+    if encoding == MSGPACK:
+        return msgpack.packb(fields)[len(_msgpack_map_header(len(fields))):]
+    return json.dumps(fields)[1:-1]
+
+
+class SharedBody:
+    """The fields of a fan-out request that every service gets, encoded once per encoding."""
+
+    def __init__(self, fields):
+        self.fields = {k: v for k, v in fields.items() if k not in PER_SERVICE_FIELDS}
+        self.__encoded = {}
+
+    def encoded(self, encoding):
+        encoded = self.__encoded.get(encoding)
+        if encoded is None:
+            encoded = self.__encoded[encoding] = _encode_fields(self.fields, encoding)
+        return encoded
+
+
+class Body:
+    """The request of one service: a SharedBody plus its own fields, like `history` and `deadline`.
+
+    Reads like the dict it stands for, and `encode` builds the bytes
+    without copying or re-encoding the shared fields.
+    """
+
+    def __init__(self, shared, **fields):
+        self.__shared = shared
+        self.__fields = fields
+
+    def get(self, key, default=None):
+        if key in self.__fields:
+            return self.__fields[key]
+        return self.__shared.fields.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.__fields:
+            return self.__fields[key]
+        return self.__shared.fields[key]
+
+    def __setitem__(self, key, value):
+        self.__fields[key] = value
+
+    def to_dict(self):
+        data = dict(self.__shared.fields)
+        data.update(self.__fields)
+        return data
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def encode(self, encoding=JSON):
+        shared = self.__shared.encoded(encoding)
+        own = _encode_fields(self.__fields, encoding)
+        if encoding == MSGPACK:
+            return _msgpack_map_header(len(self.__shared.fields) + len(self.__fields)) + shared + own
+        return ('{' + ', '.join(part for part in (shared, own) if part) + '}').encode('utf-8')
+
+
+def decode(content, content_type=None):
+    if content_type and content_type.startswith(MSGPACK):
+        return msgpack.unpackb(content)
+    return json.loads(content)
+
+
+def read_request():
+    """The body of the current Flask request, msgpack or json by its Content-Type."""
+    if request.mimetype == MSGPACK:
+        return msgpack.unpackb(request.get_data())
+    return request.json
+
+
+def response(data):
+    """`data` in msgpack if the caller asks for it by name, as json otherwise."""
+    if msgpack is not None and MSGPACK in request.headers.get('Accept', ''):
+        return flask.Response(msgpack.packb(data), mimetype=MSGPACK)
+    return json.dumps(data, ensure_ascii=False)